@@ -4,16 +4,22 @@ A neat script for looking through BibMatch Ambiguous results and comparing
 the possible matches, then appending the new record ID for the match
 """
 
-import re
 import sys
+import threading
+from collections import deque
+from Queue import Queue
 
-from time import sleep
 from urllib2 import urlopen, URLError
 
 from invenio.bibrecord import (create_record, record_add_field,
                                record_get_field_instances,
                                record_xml_output)
 
+from ratelimit import call_with_backoff, get_limiter
+from marcxml_stream import CollectionWriter, XML_DECLARATION, REGEX_RECORD
+from record_store import get_store, DEFAULT_PATH as DEFAULT_STORE
+from bibmatch_parser import iter_results
+
 # ============================== PROGRAM CONFIG ===============================
 
 # If True, attempt to download possible matches and display info from tag list
@@ -23,8 +29,18 @@ RECORD_LOOKUP = True
 AUTO_APPEND = True
 # How many attempts to download potential match in case of error during lookup
 DOWNLOAD_ATTEMPTS = 3
-# How long to wait before retry in case of a HTTP timeout (Apache default is 60)
+# Longest wait before a retry in case of a HTTP timeout (Apache default is 60),
+# retries back off exponentially up to this and honour Retry-After
 TIMEOUT_WAIT = 60
+# While one record is being looked at, download the possible matches of the
+# next PREFETCH_DEPTH records needing a lookup in the background, using
+# PREFETCH_THREADS threads and reading at most PREFETCH_READ_AHEAD records ahead
+PREFETCH_DEPTH = 5
+PREFETCH_THREADS = 4
+PREFETCH_READ_AHEAD = 1000
+# Local record store possible matches are read from and kept in (see
+# record_store.py), None to always download them
+RECORD_STORE = DEFAULT_STORE
 
 # =========================== END OF PROGRAM CONFIG ===========================
 
@@ -58,9 +74,6 @@ TAG_LIST = {'control': ['001'],
                         ('773', " ", " ", ''),
                         ('980', " ", " ", '')]}
 
-RE_MATCHED_RECORD = re.compile("<!-- BibMatch-Matching-Found: "
-                               + "(http[s]{0,1}:\/\/.*\/record\/[0-9]*)")
-
 def main():
     """ Beginning """
     help_text = ("""Apply Bibmatch Record IDs
@@ -93,78 +106,151 @@ See the internal variable TAG_LIST for details of how fields are treated."""  %
     xml_file_in = sys.argv[1]
     xml_file_out_prefix = sys.argv[2]
 
-    with open(xml_file_in) as handle:
-        textual_data = handle.read()
+    matched_output = OutputFile(xml_file_out_prefix + OUTPUT_SUFFIX_MATCHED,
+                                OUTPUT_COMMENT_MATCHED)
+    new_output = OutputFile(xml_file_out_prefix + OUTPUT_SUFFIX_NEW,
+                            OUTPUT_COMMENT_NEW)
 
-    # Step 2: parse for records
-    record_pairings = parse_xml(textual_data)
-    
-    matched_records = []
-    new_records = []
-    for record, possible_matches in record_pairings:
-        if AUTO_APPEND and len(possible_matches) == 1:
-            print("Only one recid, automatically appending...")
-        else:
-            print "\nOriginal Record"
-            print_essentials(record, TAG_LIST)
-            if RECORD_LOOKUP:
-                lookup(possible_matches)
+    # Step 2: parse for records, one at a time
+    with open(xml_file_in) as handle:
+        for record, possible_matches, pending in prefetch_matches(parse_xml(handle)):
+            if AUTO_APPEND and len(possible_matches) == 1:
+                print("Only one recid, automatically appending...")
+            else:
+                print "\nOriginal Record"
+                print_essentials(record, TAG_LIST)
+                if RECORD_LOOKUP:
+                    lookup(possible_matches, pending)
 
-        recid_appended = add_record_fields(record, possible_matches)
+            recid_appended = add_record_fields(record, possible_matches)
 
-        if recid_appended:
-            matched_records.append(record)
-        else:
-            new_records.append(record)
+            if recid_appended:
+                matched_output.write(record)
+            else:
+                new_output.write(record)
 
-    output_records(xml_file_out_prefix + OUTPUT_SUFFIX_MATCHED,
-                   matched_records, OUTPUT_COMMENT_MATCHED)
-    output_records(xml_file_out_prefix + OUTPUT_SUFFIX_NEW,
-                   new_records, OUTPUT_COMMENT_NEW)
+    matched_output.close()
+    new_output.close()
 
 
 # ===============================================
 
-def parse_xml(text):
-    """ Parses XML taken from BibMatch results, gets a list of
-    records and possible recIDs
+def parse_xml(handle):
+    """ Parses XML taken from BibMatch results, gets the records and
+    possible recIDs while reading through the open file handle
 
-    Returns a list of tuples in the form (record, matches) where
+    Generator, yields tuples in the form (record, matches) where
     record is the BibRecord representation and matches is a list
-    of possible Record IDs"""
-    results = []
-    try:
-        records = text.split("<!-- BibMatch-Matching-Results: -->")[1:]
-        records[-1] = records[-1].replace('</collection>', '')
-    except IndexError as exc:
-        print exc
-        print "Index error while parsing (sure these are BibMatch results?)"
-
-    for xml in records:
+    of possible record URLs"""
+    found = 0
+    for _, matches, _, _, xml in iter_results(handle):
+        found += 1
         bibrec = create_record(xml)[0]
-        matches = RE_MATCHED_RECORD.findall(xml)
-        tup = (bibrec, matches)
-        results.append(tup)
-    return results
+        yield (bibrec, ["%s/record/%s" % match for match in matches])
+    if not found:
+        print "No results found while parsing (sure these are BibMatch results?)"
+
+
+def needs_lookup(possible_matches):
+    """ True if the possible matches are to be downloaded and shown """
+    return RECORD_LOOKUP and not (AUTO_APPEND and len(possible_matches) == 1)
+
+
+def prefetch_matches(results, depth=PREFETCH_DEPTH, threads=PREFETCH_THREADS):
+    """ Generator, passes on the (record, matches) tuples of results as
+    (record, matches, pending) where pending lists a PendingRecord for every
+    possible match to be looked up. Reads ahead so that the matches of the
+    next `depth` records needing a lookup are downloading in the background
+    while the current one is being looked at """
+    prefetcher = Prefetcher(threads)
+    queue = deque()
+    # Records in queue whose matches are being downloaded
+    waiting = 0
+    for record, matches in results:
+        pending = []
+        if needs_lookup(matches):
+            pending = [prefetcher.fetch(url) for url in matches]
+            waiting += 1
+        queue.append((record, matches, pending))
+        while queue and (not queue[0][2] or waiting > depth or
+                         len(queue) > PREFETCH_READ_AHEAD):
+            if queue[0][2]:
+                waiting -= 1
+            yield queue.popleft()
+    while queue:
+        yield queue.popleft()
+
+
+class Prefetcher(object):
+    """ Downloads remote records on a pool of background threads, in the
+    order they were asked for """
+    def __init__(self, threads=PREFETCH_THREADS):
+        self.tasks = Queue()
+        for _ in xrange(max(1, threads)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            self.tasks.get().run()
+
+    def fetch(self, remote_url):
+        """ Queues remote_url for download, returns its PendingRecord """
+        pending = PendingRecord(remote_url)
+        self.tasks.put(pending)
+        return pending
+
+
+class PendingRecord(object):
+    """ A remote record being downloaded by a Prefetcher """
+    def __init__(self, remote_url):
+        self.remote_url = remote_url
+        self._done = threading.Event()
+        self._record = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._record = fetch_remote_record(self.remote_url)
+        except Exception as exc:
+            self._error = exc
+        finally:
+            self._done.set()
+
+    def result(self):
+        """ Waits for the download and returns the BibRecord, or raises
+        what fetch_remote_record raised """
+        # Wait in steps so that Ctrl-C still gets through
+        while not self._done.wait(0.5):
+            pass
+        if self._error is not None:
+            raise self._error
+        return self._record
 
 
-def lookup(possible_matches):
+def lookup(possible_matches, pending=None):
     """ Given a list of sources and record IDs, attempts to download
     the record from the source, then calls print_essentials() to display
     record information.
 
     Parameter
-     * possible_matches - list: List of tuples in the formal ('host', 'recid')
-            Example: [('http://cds.cern.ch', '1596995')]
+     * possible_matches - list: List of record URLs
+            Example: ['http://cds.cern.ch/record/1596995']
+     * pending - list: PendingRecord for each of possible_matches if they
+            are already being downloaded (see prefetch_matches)
     Returns:
      * None
     """
     print "Displaying possible matches information..."
-    for code, record_url in zip(generate_alpha_code(len(possible_matches)),
-                                                    possible_matches):
+    for idx, (code, record_url) in enumerate(zip(generate_alpha_code(len(possible_matches)),
+                                                 possible_matches)):
         print "Possible match (%s): %s" % (code, record_url)
         try:
-            record = fetch_remote_record(record_url)
+            if pending:
+                record = pending[idx].result()
+            else:
+                record = fetch_remote_record(record_url)
             print_essentials(record, TAG_LIST)
         except (ValueError, URLError) as exc:
             print exc
@@ -175,27 +261,40 @@ def fetch_remote_record(remote_url):
     """ Gets MARCXML from a server instance of Invenio and returns
     a single BibRecord structure.
     Raises ValueError if returned data is not MARCXML and URLError if
-    there's an issue accessing the page after DOWNLOAD_ATTEMPTS times
+    there's an issue accessing the page after DOWNLOAD_ATTEMPTS times.
+    Prints nothing, as it also runs in the background (see Prefetcher)
     """
+    base_url, _, recid = remote_url.rpartition('/record/')
+    store = get_store(RECORD_STORE) if RECORD_STORE else None
+    if store is not None:
+        xml = store.get(base_url, recid)
+        if xml is not None:
+            return create_record(xml)[0]
     url = "%s/export/xm" % (remote_url)
-    for cnt in xrange(DOWNLOAD_ATTEMPTS):
-        try:
-            handle = urlopen(url)
-            xml = handle.read()
-            handle.close()
-            record_creation = create_record(xml)
-            if record_creation[1] == 0:
-                print "Error: Could not parse record %s" % (url,)
-                raise ValueError(str(record_creation[2]))
-            return record_creation[0]
-        except URLError as exc:
-            if cnt < DOWNLOAD_ATTEMPTS - 1:
-                print "Timeout #%d: waiting %d seconds..." % (cnt, TIMEOUT_WAIT)
-                sleep(TIMEOUT_WAIT)
-            else:
-                print("ERROR: Could not download %s (tried %d times)" %
-                      (url, DOWNLOAD_ATTEMPTS))
-                raise exc
+    try:
+        xml = call_with_backoff(download, url, limiter=get_limiter(url),
+                                attempts=DOWNLOAD_ATTEMPTS,
+                                retry_on=(URLError,), cap=TIMEOUT_WAIT)
+    except URLError as exc:
+        raise URLError("ERROR: Could not download %s (tried %d times): %s" %
+                       (url, DOWNLOAD_ATTEMPTS, exc.reason))
+    record_creation = create_record(xml)
+    if record_creation[1] == 0:
+        raise ValueError("Error: Could not parse record %s: %s" %
+                         (url, record_creation[2]))
+    record_xml = REGEX_RECORD.search(xml)
+    if store is not None and record_xml:
+        store.put(base_url, recid, record_xml.group(0))
+    return record_creation[0]
+
+
+def download(url):
+    """ Returns the contents of url """
+    handle = urlopen(url)
+    try:
+        return handle.read()
+    finally:
+        handle.close()
 
 
 def print_essentials(record, tag_list):
@@ -314,20 +413,31 @@ def add_record_fields(record, possible_matches):
     # This bit can be extended
 
 
-def output_records(output_file, records, comment=''):
-    """ Write the records to file """
-    if len(records) == 0:
-        print "Nothing to write to %s" % (output_file,)
-        return
-
-    print "Writing %d records to %s" % (len(records), output_file)
-    with open(output_file, 'w') as handle:
-        handle.write('<?xml version="1.0" encoding="UTF-8"?>\n' + comment +
-                     '\n<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
-        for record in records:
-            xml = record_xml_output(record)
-            handle.write(xml + '\n')
-        handle.write('</collection>\n')
+class OutputFile(object):
+    """ Writes records to a collection file as they are decided on. The
+    file is only created once there is a record to write """
+    def __init__(self, output_file, comment=''):
+        self.output_file = output_file
+        self.comment = comment
+        self.handle = None
+        self.writer = None
+
+    def write(self, record):
+        """ Write the record to file """
+        if self.writer is None:
+            self.handle = open(self.output_file, 'w')
+            self.handle.write(XML_DECLARATION + self.comment + '\n')
+            self.writer = CollectionWriter(self.handle, declaration=False)
+        self.writer.write_record(record_xml_output(record))
+        self.handle.flush()
+
+    def close(self):
+        if self.writer is None:
+            print "Nothing to write to %s" % (self.output_file,)
+            return
+        self.writer.close()
+        self.handle.close()
+        print "Wrote %d records to %s" % (self.writer.count, self.output_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,416 @@
+#!/usr/bin/python
+"""
+Single-process asynchronous harvester: runs the search-then-fetch flow of
+invenio_harvest_script.py (search_for_ids, then get_many_records) for one or
+more queries at once on a single event loop.
+
+Record requests are multiplexed over a bounded number of persistent
+connections per host, so thousands of records can be queued without a
+thread each. Python 2 has no asyncio, so this is built on asyncore.
+"""
+
+import sys
+import time
+import heapq
+import socket
+import asyncore
+from json import loads
+from collections import deque
+from urllib import urlencode
+from urlparse import urlsplit, urljoin
+from argparse import ArgumentParser
+
+from marcxml_stream import CollectionWriter
+from ratelimit import (backoff_delay, parse_retry_after, THROTTLE_STATUSES,
+                       RETRY_STATUSES)
+
+# Persistent connections per host, i.e. requests in flight per host
+DEFAULT_CONNECTIONS = 8
+# Records of one query fetched or waiting to be written, bounds memory
+DEFAULT_WINDOW = 2000
+MAX_ATTEMPTS = 5
+RECV_SIZE = 65536
+
+
+class Request(object):
+    """ A GET request and the callback(request, body, error) to call with
+    its outcome """
+    def __init__(self, url, callback):
+        self.callback = callback
+        self.attempts = 0
+        self.set_url(url)
+
+    def set_url(self, url):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError("Only http:// URLs are supported: %s" % url)
+        self.url = url
+        self.host = parts.netloc
+        self.path = (parts.path or '/') + ('?' + parts.query
+                                           if parts.query else '')
+
+
+class HTTPChannel(asyncore.dispatcher):
+    """ One persistent HTTP/1.1 connection, running one request at a time """
+    def __init__(self, fetcher, host):
+        asyncore.dispatcher.__init__(self, map=fetcher.map)
+        self.fetcher = fetcher
+        self.host = host
+        self.request = None
+        self.outbuf = ''
+        self.inbuf = ''
+        self._reset()
+        hostname, _, port = host.partition(':')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((hostname, int(port or 80)))
+
+    def _reset(self):
+        self.state = 'head'
+        self.status = None
+        self.headers = {}
+        self.body = []
+        self.remaining = 0
+
+    def start(self, request):
+        """ Sends request, the reply is handed back to the fetcher """
+        self.request = request
+        self._reset()
+        self.outbuf = ('GET %s HTTP/1.1\r\nHost: %s\r\n'
+                       'Connection: keep-alive\r\n\r\n' %
+                       (request.path, self.host))
+
+    def writable(self):
+        return bool(self.outbuf) or not self.connected
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(RECV_SIZE)
+        if data:
+            self.inbuf += data
+            self._parse()
+
+    def _parse(self):
+        """ Consumes as much of the input buffer as the response allows """
+        while self.request is not None:
+            if self.state == 'head':
+                end = self.inbuf.find('\r\n\r\n')
+                if end < 0:
+                    return
+                lines = self.inbuf[:end].split('\r\n')
+                self.inbuf = self.inbuf[end + 4:]
+                self.status = int(lines[0].split()[1])
+                self.version = lines[0].split()[0]
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    self.headers[name.strip().lower()] = value.strip()
+                if self.status in (204, 304):
+                    self._finish()
+                elif 'chunked' in self.headers.get('transfer-encoding', ''):
+                    self.state = 'chunk_size'
+                elif 'content-length' in self.headers:
+                    self.state = 'body'
+                    self.remaining = int(self.headers['content-length'])
+                else:
+                    # Only the end of the connection ends the body, and a
+                    # keep-alive server waits for our next request: tell it
+                    # there is none so that it closes its side
+                    self.state = 'until_close'
+                    try:
+                        self.socket.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        pass
+            elif self.state == 'body':
+                piece = self.inbuf[:self.remaining]
+                self.inbuf = self.inbuf[len(piece):]
+                self.body.append(piece)
+                self.remaining -= len(piece)
+                if self.remaining:
+                    return
+                self._finish()
+            elif self.state == 'chunk_size':
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return
+                self.remaining = int(self.inbuf[:end].split(';')[0], 16)
+                self.inbuf = self.inbuf[end + 2:]
+                self.state = 'chunk_data' if self.remaining else 'trailer'
+            elif self.state == 'chunk_data':
+                if len(self.inbuf) < self.remaining + 2:
+                    return
+                self.body.append(self.inbuf[:self.remaining])
+                self.inbuf = self.inbuf[self.remaining + 2:]
+                self.state = 'chunk_size'
+            elif self.state == 'trailer':
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return
+                self.inbuf = self.inbuf[end + 2:]
+                if end == 0:
+                    self._finish()
+            else:
+                self.body.append(self.inbuf)
+                self.inbuf = ''
+                return
+
+    def _finish(self):
+        request, self.request = self.request, None
+        keep_alive = (self.version == 'HTTP/1.1' and self.state != 'until_close' and
+                      self.headers.get('connection', '').lower() != 'close')
+        if not keep_alive:
+            self.close()
+        self.fetcher.response(self, request, self.status, self.headers,
+                              ''.join(self.body))
+
+    def handle_close(self):
+        if self.request is not None and self.state == 'until_close':
+            self._finish()
+            return
+        self.close()
+        if self.request is not None:
+            request, self.request = self.request, None
+            self.fetcher.failed(request, IOError("Connection to %s closed"
+                                                 % self.host))
+
+    def handle_error(self):
+        if self.request is None:
+            # Not a transfer error but a bug in a callback, don't hide it
+            raise
+        exc = sys.exc_info()[1]
+        self.close()
+        if self.request is not None:
+            request, self.request = self.request, None
+            self.fetcher.failed(request, exc)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.fetcher.closed(self)
+
+
+class AsyncFetcher(object):
+    """ Event loop running GET requests over at most `connections`
+    persistent connections per host. Failed requests are retried with
+    backoff; a 429/503 pauses the whole host for its Retry-After. """
+    def __init__(self, connections=DEFAULT_CONNECTIONS):
+        self.map = {}
+        self.connections = connections
+        self.queues = {}
+        self.channels = {}
+        self.idle = {}
+        self.paused_until = {}
+        self.timers = []
+        self.outstanding = 0
+        self._seq = 0
+
+    def get(self, url, callback):
+        """ Queues a GET of url, callback(request, body, error) is called
+        from run() with the body or the exception that ended it """
+        self.outstanding += 1
+        self._submit(Request(url, callback))
+
+    def _later(self, when, host, request=None):
+        self._seq += 1
+        heapq.heappush(self.timers, (when, self._seq, host, request))
+
+    def _submit(self, request):
+        self.queues.setdefault(request.host, deque()).append(request)
+        self._dispatch(request.host)
+
+    def _dispatch(self, host):
+        """ Hands queued requests of host to idle or new connections """
+        queue = self.queues.get(host)
+        paused = self.paused_until.get(host, 0)
+        if paused > time.time():
+            self._later(paused, host)
+            return
+        idle = self.idle.setdefault(host, [])
+        channels = self.channels.setdefault(host, [])
+        while queue:
+            if idle:
+                channel = idle.pop()
+            elif len(channels) < self.connections:
+                channel = HTTPChannel(self, host)
+                channels.append(channel)
+            else:
+                return
+            channel.start(queue.popleft())
+
+    def response(self, channel, request, status, headers, body):
+        if channel.connected:
+            self.idle.setdefault(channel.host, []).append(channel)
+        if status == 200:
+            self._complete(request, body, None)
+        elif status in (301, 302, 303, 307) and 'location' in headers:
+            try:
+                request.set_url(urljoin(request.url, headers['location']))
+            except ValueError as exc:
+                self._complete(request, None, exc)
+            else:
+                self._submit(request)
+        else:
+            exc = IOError("HTTP %d: %s" % (status, request.url))
+            exc.status = status
+            exc.retry_after = parse_retry_after(headers.get('retry-after'))
+            if status in THROTTLE_STATUSES:
+                pause = exc.retry_after or backoff_delay(request.attempts)
+                self.paused_until[request.host] = time.time() + pause
+            self.failed(request, exc)
+        self._dispatch(channel.host)
+
+    def failed(self, request, exc):
+        """ Retries request later, or gives up after MAX_ATTEMPTS """
+        request.attempts += 1
+        status = getattr(exc, 'status', None)
+        if request.attempts >= MAX_ATTEMPTS or (
+                status is not None and status not in RETRY_STATUSES):
+            self._complete(request, None, exc)
+            return
+        delay = getattr(exc, 'retry_after', None) or \
+            backoff_delay(request.attempts)
+        print "Error (%s), retrying in %.1fs (Attempt %d)" % (
+            exc, delay, request.attempts)
+        self._later(time.time() + delay, request.host, request)
+
+    def closed(self, channel):
+        for pool in (self.channels, self.idle):
+            if channel in pool.get(channel.host, []):
+                pool[channel.host].remove(channel)
+
+    def _complete(self, request, body, error):
+        self.outstanding -= 1
+        request.callback(request, body, error)
+
+    def run(self):
+        """ Runs the loop until every queued request has completed """
+        while self.outstanding:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, host, request = heapq.heappop(self.timers)
+                if request is not None:
+                    self._submit(request)
+                else:
+                    self._dispatch(host)
+            timeout = 1.0
+            if self.timers:
+                timeout = max(0.0, min(timeout, self.timers[0][0] - now))
+            if self.map:
+                asyncore.loop(timeout=timeout, map=self.map, count=1)
+            else:
+                time.sleep(timeout)
+        for channel in self.map.values():
+            channel.close()
+
+
+class QueryHarvest(object):
+    """ Search-then-fetch harvest of one query (or list of recids) into its
+    own MARCXML file, records written in search order """
+    def __init__(self, fetcher, server_url, output, search_terms=None,
+                 fields='', recids=None, window=DEFAULT_WINDOW):
+        self.fetcher = fetcher
+        self.server_url = server_url
+        self.output = output
+        self.window = window
+        self.handle = open(output, 'w')
+        self.writer = CollectionWriter(self.handle)
+        self.results = {}
+        self.next_write = 0
+        self.next_issue = 0
+        self.total = 0
+        if recids is not None:
+            self._start(recids)
+        else:
+            params = {'ln': 'en', 'of': 'id', 'action_search': 'Search',
+                      'p': search_terms, 'f': fields}
+            url = '%s/search?%s' % (server_url, urlencode(params))
+            print 'Searching %s' % (url,)
+            fetcher.get(url, self.got_ids)
+
+    def got_ids(self, request, body, error):
+        if error is not None:
+            print "ERROR: Search failed for %s: %s" % (self.output, error)
+            self.finish()
+            return
+        self._start(loads(body))
+
+    def _start(self, recids):
+        self.recids = deque(recids)
+        self.total = len(self.recids)
+        print "%s: getting %d records..." % (self.output, self.total)
+        self._issue()
+        if not self.total:
+            self.finish()
+
+    def _issue(self):
+        while self.recids and self.next_issue - self.next_write < self.window:
+            idx = self.next_issue
+            self.next_issue += 1
+            url = "%s/record/%s/export/xm" % (self.server_url,
+                                              self.recids.popleft())
+            self.fetcher.get(url, lambda request, body, error, idx=idx:
+                             self.got_record(idx, request, body, error))
+
+    def got_record(self, idx, request, body, error):
+        if error is not None:
+            print "ERROR: Could not get %s: %s" % (request.url, error)
+        self.results[idx] = body or ''
+        while self.next_write in self.results:
+            self.writer.write_records_from(self.results.pop(self.next_write))
+            self.next_write += 1
+        self._issue()
+        if self.next_write == self.total:
+            self.finish()
+
+    def finish(self):
+        self.writer.close()
+        self.handle.close()
+        print "%s: wrote %d records" % (self.output, self.writer.count)
+
+
+def main():
+    desc = """Harvests one or more searches from an external Invenio instance
+concurrently on one event loop, each to its own MARCXML file."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('remote_server', help="Remote Invenio instance to download records from")
+    parser.add_argument('-q', '--query', nargs=2, action='append', default=[],
+                        metavar=('TERMS', 'OUTPUT'),
+                        help="Search terms and the file to write matches to (repeatable)")
+    parser.add_argument('-i', '--ids', nargs=2, action='append', default=[],
+                        metavar=('IDS', 'OUTPUT'),
+                        help="Comma separated record IDs and the file to write them to (repeatable)")
+    parser.add_argument('-f', '--fields', help="Fields to search in (e.g. title)", default='')
+    parser.add_argument('-c', '--connections', type=int, default=DEFAULT_CONNECTIONS,
+                        help="Connections per host (default %d)" % DEFAULT_CONNECTIONS)
+    parser.add_argument('-w', '--window', type=int, default=DEFAULT_WINDOW,
+                        help="Records per query in flight or awaiting write (default %d)" % DEFAULT_WINDOW)
+    arghs = parser.parse_args()
+    if not arghs.query and not arghs.ids:
+        parser.error("Give at least one -q or -i")
+
+    server_url = arghs.remote_server
+    if not server_url.startswith('http://'):
+        server_url = "http://" + server_url
+    fetcher = AsyncFetcher(max(1, arghs.connections))
+    started = time.time()
+    harvests = []
+    for terms, output in arghs.query:
+        harvests.append(QueryHarvest(fetcher, server_url, output,
+                                     search_terms=terms, fields=arghs.fields,
+                                     window=arghs.window))
+    for ids, output in arghs.ids:
+        harvests.append(QueryHarvest(fetcher, server_url, output,
+                                     recids=ids.split(','),
+                                     window=arghs.window))
+    fetcher.run()
+    records = sum(harvest.writer.count for harvest in harvests)
+    elapsed = time.time() - started
+    print "Harvested %d records in %.1fs (%.1f records/s)" % (
+        records, elapsed, records / elapsed if elapsed else 0)
+
+
+if __name__ == '__main__':
+    main()
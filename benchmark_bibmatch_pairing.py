@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+Benchmarks pairing BibMatch headers with their records: the one-pass
+scanner used by bibmatch_record_massage (marcxml_stream's
+iter_commented_records) against the regex it replaced, on a generated
+BibMatch result file.
+
+--stray puts a comment inside every Nth record. The regex then starts the
+next header at that comment and swallows the end of the record into it;
+such headers are counted as "spanning a record".
+
+Usage: $ python benchmark_bibmatch_pairing.py [--records 100000]
+                                              [--comments 4] [--stray 0]
+"""
+
+import re
+import time
+from StringIO import StringIO
+from argparse import ArgumentParser
+
+from marcxml_stream import iter_commented_records, XML_DECLARATION, \
+                           COLLECTION_OPEN, COLLECTION_CLOSE
+from invenio_standin import Corpus
+
+# What bibmatch_record_massage used before
+LEGACY_RECORD_COMMENT = re.compile(r"(<!--.*?-->)\s*<record>",
+                                   re.MULTILINE | re.DOTALL)
+
+
+def generate(records, comments, stray):
+    """ Returns the text of a BibMatch result file """
+    corpus = Corpus(records)
+    out = [XML_DECLARATION, COLLECTION_OPEN, '\n']
+    for recid in xrange(1, records + 1):
+        out.append('<!-- BibMatch-Matching-Results: -->\n')
+        for idx in xrange(comments - 1):
+            out.append('<!-- BibMatch-Matching-Found: '
+                       'http://inspirebeta.net/record/%d -->\n' % (recid * 10 + idx))
+        xml = corpus.record(recid)
+        if stray and recid % stray == 0:
+            xml = xml.replace('</record>', '<!-- note -->\n</record>')
+        out.append(xml + '\n')
+    out.append(COLLECTION_CLOSE)
+    return ''.join(out)
+
+
+def pair_legacy(text):
+    return LEGACY_RECORD_COMMENT.findall(text)
+
+
+def pair_scanner(text):
+    return [header for header, _ in iter_commented_records(StringIO(text))]
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks BibMatch header/record pairing.")
+    parser.add_argument('-n', '--records', type=int, default=100000,
+                        help="Records in the generated file (default 100000)")
+    parser.add_argument('-c', '--comments', type=int, default=4,
+                        help="Comments before every record (default 4)")
+    parser.add_argument('-s', '--stray', type=int, default=0,
+                        help="Put a comment inside every Nth record (default never)")
+    arghs = parser.parse_args()
+
+    text = generate(arghs.records, max(arghs.comments, 1), arghs.stray)
+    print "%d records, %.1f MB" % (arghs.records, len(text) / 1048576.0)
+    results = {}
+    for name, pair in (('scanner', pair_scanner), ('legacy regex', pair_legacy)):
+        begin = time.time()
+        headers = pair(text)
+        elapsed = time.time() - begin
+        results[name] = headers
+        spanning = sum(1 for header in headers if '</record>' in header)
+        print "%-14s %8d headers %8.2fs %10.1f rec/s %6d spanning a record" % (
+            name, len(headers), elapsed,
+            arghs.records / elapsed if elapsed else 0.0, spanning)
+    if not arghs.stray and results['scanner'] != results['legacy regex']:
+        print "WARNING: the scanner and the regex found different headers"
+
+
+if __name__ == '__main__':
+    main()
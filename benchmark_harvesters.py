@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""
+Benchmarks the harvesters against a local Invenio stand-in (see
+invenio_standin.py), reporting records/sec and the latency percentiles
+of each page or record fetch (retries included) for:
+ * harvest.run_query, page by page
+ * harvest.run_query_parallel
+ * invenio_harvest_script.get_many_records, record by record
+
+The page cache is bypassed and the per-host rate limiter is opened up to
+--rate requests/sec, so the figures measure the harvesters themselves.
+
+Usage: $ python benchmark_harvesters.py [--records 2000] [--latency 0.02]
+                                        [--error-rate 0] [--jobs 1,4,8]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+import harvest
+import invenio_harvest_script
+from ratelimit import get_limiter
+from harvest_cache import HarvestCache
+from invenio_standin import StandinServer
+
+
+class Timings(object):
+    """ Wraps a function, recording how long each call took """
+    def __init__(self, func):
+        self.func = func
+        self.times = []
+
+    def __call__(self, *args, **kwargs):
+        begin = time.time()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.times.append(time.time() - begin)
+
+    def percentile(self, percent):
+        if not self.times:
+            return 0.0
+        ordered = sorted(self.times)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+
+@contextmanager
+def patched(module, name, value):
+    """ Temporarily replaces module.name by value """
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield value
+    finally:
+        setattr(module, name, original)
+
+
+@contextmanager
+def quiet():
+    """ Silences the harvesters' progress output """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def open_limiter(url, rate, burst):
+    """ Lets requests to url's host through at up to rate per second """
+    limiter = get_limiter(url)
+    limiter.rate = limiter.max_rate = float(rate)
+    limiter.burst = limiter.tokens = burst
+    limiter.paused_until = 0.0
+
+
+def bench_run_query(server, jobs, cache_dir):
+    """ Returns (records, seconds, timings) for one harvest.py run """
+    cache = HarvestCache(cache_dir)
+    timings = Timings(harvest.fetch_page)
+    with patched(harvest, 'fetch_page', timings), quiet():
+        begin = time.time()
+        if jobs > 1:
+            pages = harvest.run_query_parallel(server.url, 'xm', '', '', True,
+                                               jobs=jobs, cache=cache)
+        else:
+            pages = harvest.run_query(server.url, 'xm', '', '', True,
+                                      cache=cache)
+        records = 0
+        for page in pages:
+            records += len(harvest.REGEX_RECORD.findall(page))
+        elapsed = time.time() - begin
+    if jobs <= 1:
+        # run_query sees the last page twice before it stops
+        records -= min(harvest.PAGE_SIZE, server.corpus.size)
+    return records, elapsed, timings
+
+
+def bench_get_many_records(server, jobs, recids):
+    """ Returns (records, seconds, timings) for one
+    invenio_harvest_script.get_many_records run """
+    timings = Timings(invenio_harvest_script.fetch_record)
+    with patched(invenio_harvest_script, 'fetch_record', timings), quiet():
+        with open(os.devnull, 'w') as handle:
+            begin = time.time()
+            records = invenio_harvest_script.get_many_records(
+                server.url, recids, handle, jobs)
+            elapsed = time.time() - begin
+    return records, elapsed, timings
+
+
+def report(name, jobs, records, elapsed, timings):
+    print "%-28s %4d %8d %8.1f %8.1f %8.1f %8.1f %9d" % (
+        name, jobs, records, records / elapsed if elapsed else 0.0,
+        timings.percentile(50) * 1000, timings.percentile(90) * 1000,
+        timings.percentile(99) * 1000, len(timings.times))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks the harvesters against a local Invenio stand-in.")
+    parser.add_argument('-n', '--records', type=int, default=2000,
+                        help="Size of the synthetic corpus (default 2000)")
+    parser.add_argument('-r', '--recids', type=int, default=500,
+                        help="Records fetched one by one by get_many_records (default 500)")
+    parser.add_argument('-l', '--latency', type=float, default=0.02,
+                        help="Mean latency added by the server per request, in seconds (default 0.02)")
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help="Fraction of requests the server answers with 503 (default 0)")
+    parser.add_argument('-j', '--jobs', default='1,4,8',
+                        help="Comma separated thread counts to try (default 1,4,8)")
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help="Requests/sec the rate limiter lets through (default 1000)")
+    arghs = parser.parse_args()
+    jobs_list = [int(jobs) for jobs in arghs.jobs.split(',')]
+
+    server = StandinServer(0, arghs.records, arghs.latency, arghs.error_rate)
+    server.start()
+    cache_dir = tempfile.mkdtemp(prefix='harvest_bench_')
+    recids = range(1, min(arghs.recids, arghs.records) + 1)
+    print "Stand-in at %s: %d records, %.0fms mean latency, %.1f%% errors" % (
+        server.url, arghs.records, arghs.latency * 1000, arghs.error_rate * 100)
+    print "%-28s %4s %8s %8s %8s %8s %8s %9s" % (
+        'harvester', 'jobs', 'records', 'rec/s', 'p50 ms', 'p90 ms',
+        'p99 ms', 'fetches')
+    try:
+        for jobs in jobs_list:
+            open_limiter(server.url, arghs.rate, max(jobs, 1) * 2)
+            name = 'harvest.run_query' if jobs <= 1 else 'harvest.run_query_parallel'
+            report(name, jobs, *bench_run_query(server, jobs, cache_dir))
+        for jobs in jobs_list:
+            open_limiter(server.url, arghs.rate, max(jobs, 1) * 2)
+            report('get_many_records', jobs,
+                   *bench_get_many_records(server, jobs, recids))
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
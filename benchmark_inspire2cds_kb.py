@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""
+Benchmarks the knowledge base lookups of inspire2cds.xsl on a generated
+journal KB of --journals entries.
+
+First the lookup itself: a linear scan with the translate() predicate the
+stylesheet used before against an xsl:key index, both in one transformation.
+Then the whole of inspire2cds.xsl (or of --baseline, e.g. an older copy from
+git) converting generated records whose 773 titles all go through the KB.
+
+Usage: $ python benchmark_inspire2cds_kb.py [--journals 20000]
+                                             [--records 2000]
+                                             [--baseline old.xsl]
+"""
+
+import os
+import time
+import random
+import shutil
+import tempfile
+from io import BytesIO
+from argparse import ArgumentParser
+
+from lxml import etree
+
+from xslt_conversion import load_stylesheet, iter_converted
+
+STYLESHEET = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'inspire2cds.xsl')
+
+LOOKUP = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+%s
+<xsl:template match="/">
+  <titles>
+    <xsl:for-each select="titles/title">
+      <xsl:variable name="title" select="." />
+      <title>%s</title>
+    </xsl:for-each>
+  </titles>
+</xsl:template>
+</xsl:stylesheet>"""
+LINEAR_LOOKUP = LOOKUP % ('', """<xsl:value-of select="document('cds_inspire_journal_abbreviations.xml')/mappings/journal-title/inspire[translate(., ' ', '') = translate($title, ' ', '')]/preceding-sibling::*[1]" />""")
+KEYED_LOOKUP = LOOKUP % (
+    """<xsl:key name="journal-titles" match="mappings/journal-title/inspire" use="translate(., ' ', '')" />""",
+    """<xsl:for-each select="document('cds_inspire_journal_abbreviations.xml')"><xsl:value-of select="key('journal-titles', translate($title, ' ', ''))/preceding-sibling::*[1]" /></xsl:for-each>""")
+
+# The other KBs only need to exist
+SMALL_KBS = {
+    'cds_inspire_693.xml': '<experiments><experiment><cds>CERN LHC---ATLAS</cds>'
+                           '<inspire>CERN-LHC-ATLAS</inspire></experiment></experiments>',
+    'cds_inspire_categories_65017.xml': '<categories><category><inspire>Theory-HEP</inspire>'
+                                        '<cds>Particle Physics - Theory</cds></category></categories>',
+    # German is both an entry and part of another one, the records of the
+    # benchmark have either
+    'cds_inspire_languages.xml': '<languages><language><inspire>German</inspire>'
+                                 '<cds>ger</cds></language><language>'
+                                 '<inspire>Swiss German</inspire><cds>gsw</cds>'
+                                 '</language></languages>',
+}
+
+
+def inspire_title(idx):
+    return 'J.Number%d' % (idx,)
+
+
+def write_kbs(directory, journals):
+    """ Writes the KBs, the journal one with journals entries """
+    with open(os.path.join(directory, 'cds_inspire_journal_abbreviations.xml'), 'w') as handle:
+        handle.write('<mappings>\n')
+        for idx in xrange(journals):
+            handle.write('<journal-title><cds>Journal Number %d</cds><inspire>%s</inspire>'
+                         '</journal-title>\n' % (idx, inspire_title(idx)))
+        handle.write('</mappings>\n')
+    for name, text in SMALL_KBS.items():
+        with open(os.path.join(directory, name), 'w') as handle:
+            handle.write(text)
+
+
+def generate_records(count, journals):
+    """ Returns a MARCXML collection of count records citing random journals
+    of the KB """
+    out = ['<collection xmlns="http://www.loc.gov/MARC21/slim">']
+    for recid in xrange(1, count + 1):
+        out.append('<record><controlfield tag="001">%d</controlfield>'
+                   '<datafield tag="041" ind1=" " ind2=" "><subfield code="a">%s</subfield></datafield>'
+                   '<datafield tag="245" ind1=" " ind2=" "><subfield code="a">Record %d</subfield></datafield>'
+                   '<datafield tag="650" ind1="1" ind2="7"><subfield code="a">Theory-HEP</subfield></datafield>'
+                   '<datafield tag="693" ind1=" " ind2=" "><subfield code="e">CERN-LHC-ATLAS</subfield></datafield>'
+                   '<datafield tag="773" ind1=" " ind2=" "><subfield code="p">%s</subfield>'
+                   '<subfield code="v">%d</subfield><subfield code="y">2013</subfield></datafield>'
+                   '</record>' % (recid, ('German', 'Swiss German')[recid % 2], recid,
+                                  inspire_title(random.randrange(journals)), recid % 100))
+    out.append('</collection>')
+    return ''.join(out)
+
+
+def timed(func, *args):
+    begin = time.time()
+    result = func(*args)
+    return result, time.time() - begin
+
+
+def bench_lookups(directory, journals, lookups):
+    """ Prints the time of lookups journal lookups, linear and keyed """
+    titles = etree.XML('<titles>%s</titles>' % ''.join(
+        '<title>%s</title>' % inspire_title(random.randrange(journals))
+        for _ in xrange(lookups)))
+    results = {}
+    for name, text in (('linear scan', LINEAR_LOOKUP), ('xsl:key', KEYED_LOOKUP)):
+        path = os.path.join(directory, 'lookup.xsl')
+        with open(path, 'w') as handle:
+            handle.write(text)
+        xslt = load_stylesheet(path)
+        result, elapsed = timed(xslt, titles)
+        results[name] = str(result)
+        print "%-12s %6d lookups %9.3fs %12.1f lookups/s" % (
+            name, lookups, elapsed, lookups / elapsed if elapsed else 0.0)
+    if results['linear scan'] != results['xsl:key']:
+        print "WARNING: the linear scan and the key found different titles"
+
+
+def bench_stylesheet(name, path, records):
+    """ Prints records/sec of the stylesheet at path on the whole collection
+    at once and streaming, returns the converted records """
+    xslt = load_stylesheet(path)
+    count = records.count('<record>')
+    _, whole = timed(xslt, etree.XML(records))
+    converted, stream = timed(lambda: list(iter_converted(xslt, BytesIO(records))))
+    print "%-22s whole file %8.2fs %9.1f rec/s   streaming %8.2fs %9.1f rec/s" % (
+        name, whole, count / whole if whole else 0.0,
+        stream, count / stream if stream else 0.0)
+    return converted
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks the KB lookups of inspire2cds.xsl.")
+    parser.add_argument('-n', '--journals', type=int, default=20000,
+                        help="Entries in the generated journal KB (default 20000)")
+    parser.add_argument('-r', '--records', type=int, default=2000,
+                        help="Records converted by the stylesheets (default 2000)")
+    parser.add_argument('-l', '--lookups', type=int, default=1000,
+                        help="Lookups timed on their own (default 1000)")
+    parser.add_argument('-b', '--baseline',
+                        help="Another version of inspire2cds.xsl to compare with")
+    arghs = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='inspire2cds_bench_')
+    try:
+        write_kbs(directory, arghs.journals)
+        print "Journal KB of %d entries" % (arghs.journals,)
+        bench_lookups(directory, arghs.journals, arghs.lookups)
+
+        records = generate_records(arghs.records, arghs.journals)
+        stylesheets = [('inspire2cds.xsl', STYLESHEET)]
+        if arghs.baseline:
+            stylesheets.append(('baseline', arghs.baseline))
+        outputs = {}
+        for name, path in stylesheets:
+            # document() finds the KBs next to the stylesheet
+            copy = os.path.join(directory, 'bench_%s' % (os.path.basename(path),))
+            shutil.copy(path, copy)
+            outputs[name] = bench_stylesheet(name, copy, records)
+        if arghs.baseline and outputs['inspire2cds.xsl'] != outputs['baseline']:
+            print "WARNING: inspire2cds.xsl and the baseline converted differently"
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""
+Benchmarks marcxml_reader.iter_create_records against bibrecord's
+create_records on a synthetic MARCXML file, reporting records/sec and the
+peak memory of each reader. Every reader runs in its own process so the
+peaks do not mix.
+
+Usage: $ python benchmark_marcxml_reader.py [--records 100000] [--file path]
+"""
+
+import os
+import time
+import resource
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+
+from marcxml_reader import iter_create_records, HAS_LXML
+from marcxml_stream import CollectionWriter
+from invenio_standin import Corpus
+
+try:
+    from invenio.bibrecord import create_records
+    HAS_INVENIO = True
+except ImportError:
+    try:
+        from invenio.legacy.bibrecord import create_records
+        HAS_INVENIO = True
+    except ImportError:
+        HAS_INVENIO = False
+
+
+def write_corpus(path, size):
+    """ Writes size synthetic records to path """
+    corpus = Corpus(size)
+    with open(path, 'w') as handle:
+        writer = CollectionWriter(handle)
+        for recid in xrange(1, size + 1):
+            writer.write_record(corpus.record(recid))
+        writer.close()
+
+
+def read_bibrecord(path):
+    with open(path) as handle:
+        return sum(1 for _, code, _ in create_records(handle.read())
+                   if code == 1)
+
+
+def read_lxml(path):
+    return sum(1 for _, code, _ in iter_create_records(path) if code == 1)
+
+
+def measure(reader, path, results):
+    begin = time.time()
+    count = reader(path)
+    elapsed = time.time() - begin
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((count, elapsed, peak))
+
+
+def run(reader, path):
+    """ Returns (records, seconds, peak RSS in kB) for reader """
+    results = Queue()
+    process = Process(target=measure, args=(reader, path, results))
+    process.start()
+    outcome = results.get()
+    process.join()
+    return outcome
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks the lxml MARCXML reader against create_records.")
+    parser.add_argument('-n', '--records', type=int, default=100000,
+                        help="Records in the generated file (default 100000)")
+    parser.add_argument('-f', '--file',
+                        help="Benchmark on this MARCXML file instead of a generated one")
+    arghs = parser.parse_args()
+
+    path = arghs.file
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.xml', prefix='marcxml_bench_')
+        os.close(fd)
+        print "Writing %d records to %s..." % (arghs.records, path)
+        write_corpus(path, arghs.records)
+    readers = []
+    if HAS_LXML:
+        readers.append(('marcxml_reader.iter_create_records', read_lxml))
+    else:
+        print "lxml is not installed, skipping marcxml_reader"
+    if HAS_INVENIO:
+        readers.append(('bibrecord.create_records', read_bibrecord))
+    else:
+        print "Invenio is not installed, skipping create_records"
+    try:
+        print "%-38s %9s %9s %10s %12s" % ('reader', 'records', 'seconds',
+                                           'rec/s', 'peak RSS MB')
+        for name, reader in readers:
+            count, elapsed, peak = run(reader, path)
+            print "%-38s %9d %9.2f %10.1f %12.1f" % (
+                name, count, elapsed, count / elapsed if elapsed else 0.0,
+                peak / 1024.0)
+    finally:
+        if not arghs.file:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
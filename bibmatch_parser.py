@@ -0,0 +1,84 @@
+"""
+Streaming parser for BibMatch result files.
+
+BibMatch writes every input record preceded by a block of comments:
+
+  <!-- BibMatch-Matching-Results: -->
+  <!-- BibMatch-Matching-Mode: exact -->
+  <!-- BibMatch-Matching-Criteria: [title] -->
+  <!-- BibMatch-Matching-Found: http://inspirebeta.net/record/123 -->
+  <record>...</record>
+
+iter_results() reads such a file in chunks and yields one result at a time,
+so tools working through large result files only ever hold one record.
+"""
+
+import re
+
+from marcxml_stream import CHUNK_SIZE, REGEX_RECORD
+
+RESULTS_MARKER = '<!-- BibMatch-Matching-Results: -->'
+
+RE_COMMENT = re.compile('<!--(.*?)-->', re.DOTALL)
+RE_MATCHED = re.compile(r'<!-- BibMatch-Matching-Found: (https?://.*)/record/([0-9]*)')
+RE_MODE = re.compile('<!-- BibMatch-Matching-Mode: (.+?) -->')
+RE_CRITERIA = re.compile('<!-- BibMatch-Matching-Criteria: (.*) -->')
+
+
+def iter_results(handle, chunk_size=CHUNK_SIZE):
+    """ Generator, yields a tuple for every result in an open BibMatch
+    result file:
+
+    (headers, matches, mode, criteria, xml)
+     * headers - list: text of every comment before the record
+     * matches - list: (base URL, recid) tuples of the records found
+     * mode - str: matching mode, None if not given
+     * criteria - list: matching criteria
+     * xml - str: the <record> element, '' if there is none
+    Anything before the first result (e.g. <collection>) is skipped. """
+    buf = ''
+    # Where to look for the marker ending the result at the start of buf
+    search_from = 0
+    eof = False
+    while True:
+        start = buf.find(RESULTS_MARKER)
+        if start >= 0:
+            if start > 0:
+                buf = buf[start:]
+                search_from = max(0, search_from - start)
+            search_from = max(search_from, len(RESULTS_MARKER))
+            end = buf.find(RESULTS_MARKER, search_from)
+            if end >= 0:
+                yield parse_result(buf[len(RESULTS_MARKER):end])
+                buf = buf[end:]
+                search_from = 0
+                continue
+            if eof:
+                yield parse_result(buf[len(RESULTS_MARKER):])
+                return
+            # Keep a tail in case the next marker is split across chunks
+            search_from = max(len(RESULTS_MARKER),
+                              len(buf) - len(RESULTS_MARKER) + 1)
+        elif eof:
+            return
+        else:
+            buf = buf[-len(RESULTS_MARKER) + 1:]
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf += chunk
+
+
+def parse_result(text):
+    """ Parses the text of one result (without its marker) into the tuple
+    described in iter_results() """
+    record = REGEX_RECORD.search(text)
+    if record:
+        comments, xml = text[:record.start()], record.group(0)
+    else:
+        comments, xml = text, ''
+    headers = [comment.strip() for comment in RE_COMMENT.findall(comments)]
+    mode = RE_MODE.search(comments)
+    return (headers, RE_MATCHED.findall(comments),
+            mode.group(1) if mode else None,
+            RE_CRITERIA.findall(comments), xml)
@@ -2,12 +2,21 @@
 """
 Utility to massage records from BibMatch
 
-Add rules for massaging and place the function names in ACTIVE_RULES
+Add rules for massaging and place the function names in ACTIVE_RULES; declare
+the tags a rule reads and writes with @rule so it only runs where it applies
+
+Usage: $ python bibmatch_record_massage.py [-s] [in.xml] [out.xml]
+
+ -s, --stream   read, massage and write one record and its BibMatch header at
+                a time, in constant memory
 """
 
 import sys
 import re
 import codecs
+import getopt
+from io import BytesIO
+from StringIO import StringIO
 
 from invenio.legacy.bibrecord import (create_records,
                                       record_get_field_instances,
@@ -16,14 +25,18 @@ from invenio.legacy.bibrecord import (create_records,
                                       record_xml_output,
                                       record_delete_fields)
 
+from marcxml_reader import iter_create_records, HAS_LXML
+from marcxml_stream import iter_commented_records
+
+
+# Read the input with the streaming lxml reader (marcxml_reader) instead of
+# create_records whenever lxml is installed
+FAST_READER = True
 
 MARCXML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
 <collection xmlns="http://www.loc.gov/MARC21/slim">"""
 MARCXML_FOOTER = "</collection>"
 
-MARCXML_RECORD_COMMENT = re.compile(r"(<!--.*?-->)\s*<record>",
-                                    re.MULTILINE | re.DOTALL)
-
 BIBMATCH_MATCHED = "<!-- BibMatch-Matching-Mode: exact-matched -->"
 
 REGEX_BIBMATCH_RESULTS = re.compile(
@@ -32,6 +45,25 @@ REGEX_BIBMATCH_RESULTS = re.compile(
 
 # ===================| RULES |========================
 
+def rule(reads=None, writes=()):
+    """Declares the tags a rule reads and writes. The rule is skipped for
+    records holding none of the tags it reads; with reads=None (or no
+    declaration at all) it runs on every record. writes=None declares a rule
+    that may change any tag"""
+    def decorator(func):
+        func.reads = frozenset(reads) if reads is not None else None
+        func.writes = frozenset(writes) if writes is not None else None
+        return func
+    return decorator
+
+
+def is_triggered(rule_func, record):
+    """Whether the rule has anything to work on in record"""
+    reads = getattr(rule_func, 'reads', None)
+    return reads is None or any(tag in record for tag in reads)
+
+
+@rule(reads=['856'], writes=['FFT'])
 def rule_create_fft(header, record):
     for field in record_get_field_instances(record, '856', ind1='4'):
         url = None
@@ -45,6 +77,7 @@ def rule_create_fft(header, record):
     return record
 
 
+@rule(writes=['001'])
 def rule_add_recid(header, record):
     # if not BIBMATCH_MATCHED in header:
     #     return record
@@ -58,6 +91,7 @@ def rule_add_recid(header, record):
     return record
 
 
+@rule(reads=['773'], writes=['773'])
 def rule_change_conf_num(header, record):
     substitutes = {
         "C78-09-18xxx": "C78-09-18.2"
@@ -69,6 +103,7 @@ def rule_change_conf_num(header, record):
     return record
 
 
+@rule(reads=None, writes=None)
 def rule_filter_out_fields(header, record):
     interesting_fields = ['001', '695', '773', '856', 'FFT']
     for tag in record.keys():
@@ -127,15 +162,32 @@ class MassageTask(object):
 # ==================| CODE |=======================
 
 def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s", ["stream"])
+    except getopt.GetoptError as err:
+        _print(TF.RED + "Error: %s" % (err,) + TF.END)
+        sys.exit(1)
+    stream = False
+    for opt, _ in opts:
+        if opt in ['-s', '--stream']:
+            stream = True
+    input_file = args[0] if len(args) > 0 else None
+    output_file = args[1] if len(args) > 1 else None
+
+    if stream:
+        print_active_rules()
+        massage_stream(input_file, output_file)
+        return
+
     # get records
-    records, marcxml = get_records()
+    records, marcxml = get_records(input_file)
     container = MassageTask(records, marcxml)
 
     # massage with rules
     print_active_rules()
     run_rules(container)
     # output
-    output_records(container)
+    output_records(container, output_file)
 
 
 def _print(msg):
@@ -143,58 +195,124 @@ def _print(msg):
 
 
 def get_bibmatch_headers(marcxml):
-    return MARCXML_RECORD_COMMENT.findall(marcxml)
+    """Returns the comment block before every record in marcxml, '' for
+    records without one, in a single pass over the text"""
+    return [header for header, _ in
+            iter_commented_records(StringIO(marcxml))]
 
 
-def get_records():
-    """Fetch records either from file or from StdIn"""
+def get_records(input_file=None):
+    """Fetch records either from file or from StdIn, returns them with the
+    decoded input text (for its BibMatch headers)"""
     try:
-        with codecs.open(sys.argv[1], encoding='utf-8', mode='r') as handle:
-            input_xml = handle.read()
+        with open(input_file, 'rb') as handle:
+            raw_xml = handle.read()
     except Exception:
-        input_xml = sys.stdin.read()
+        raw_xml = sys.stdin.read()
+    input_xml = raw_xml.decode('utf-8')
+
+    if FAST_READER and HAS_LXML:
+        # lxml reads the bytes as they are, decoding them itself
+        records_in = iter_create_records(BytesIO(raw_xml))
+    else:
+        records_in = create_records(input_xml)
+    records_out = list(check_records(records_in))
+    _print(TF.YELLOW + "Processing %d records" % len(records_out) + TF.END)
+    return records_out, input_xml
+
 
-    records_out = []
-    for record, code, errors in create_records(input_xml):
+def check_records(records_in):
+    """Generator, yields the records from (record, code, errors) tuples,
+    raises ValueError on the first one that could not be parsed"""
+    for record, code, errors in records_in:
         if code != 1:
             msg = "Record Error: %s%s" % (str(record)[:30], str(errors))
             raise ValueError(msg)
-        records_out.append(record)
-    _print(TF.YELLOW + "Processing %d records" % len(records_out) + TF.END)
-    return records_out, input_xml
+        yield record
 
 
 def print_active_rules():
     """Print active rules to StdErr"""
     _print(TF.BOLD + TF.PURPLE + "Active Rules:" + TF.END * 2)
-    for rule in ACTIVE_RULES:
-        _print(" * %s%s%s" % (TF.GREEN, rule.__name__, TF.END))
+    for rule_func in ACTIVE_RULES:
+        reads = getattr(rule_func, 'reads', None)
+        writes = getattr(rule_func, 'writes', ())
+        _print(" * %s%s%s (reads: %s, writes: %s)" % (
+            TF.GREEN, rule_func.__name__, TF.END,
+            ','.join(sorted(reads)) if reads is not None else 'any',
+            'any' if writes is None else ','.join(sorted(writes)) or 'undeclared'))
 
 
 def run_rules(container):
-    """Specified active rules are ran against records"""
-    for rule in ACTIVE_RULES:
-        for idx, (header, record) in enumerate(container):
-            container.records[idx] = rule(header, record)
+    """Specified active rules are ran against records, all of them on one
+    record before moving to the next"""
+    for idx, (header, record) in enumerate(container):
+        container.records[idx] = apply_rules(header, record)
 
 
-def output_records(container):
+def apply_rules(header, record):
+    """Runs the active rules that have something to work on in record"""
+    for rule_func in ACTIVE_RULES:
+        if is_triggered(rule_func, record):
+            record = rule_func(header, record)
+    return record
+
+
+def open_output(output_file=None):
+    """Opens the output file, StdOut if there is none"""
     try:
-        strio = codecs.open(sys.argv[2], mode='w', encoding='utf-8')
-        _print(TF.YELLOW + "Writing to %s" % (sys.argv[2],) + TF.END)
+        strio = codecs.open(output_file, mode='w', encoding='utf-8')
+        _print(TF.YELLOW + "Writing to %s" % (output_file,) + TF.END)
     except Exception:
         strio = sys.stdout
         _print(TF.YELLOW + "Writing to StdOut" + TF.END)
+    return Streamer(strio, '\n')
+
 
-    stream = Streamer(strio, '\n')
+def output_records(container, output_file=None):
+    stream = open_output(output_file)
     stream.write(MARCXML_HEADER)
     for header, record in container:
-        stream.write(header)
+        if header:
+            stream.write(header)
         marcxml = record_xml_output(record)
         stream.write(marcxml)
 
     stream.write(MARCXML_FOOTER)
 
 
+# ==================| STREAMING |=======================
+
+def iter_input_records(input_file=None):
+    """Generator, yields (header, record) for the input file (or StdIn)
+    one record at a time; header is '' for records without one"""
+    try:
+        handle = open(input_file, 'rb')
+    except Exception:
+        handle = sys.stdin
+    for header, xml in iter_commented_records(handle):
+        if FAST_READER and HAS_LXML:
+            records_in = iter_create_records(BytesIO(xml))
+        else:
+            records_in = create_records(xml)
+        for record in check_records(records_in):
+            yield header, record
+
+
+def massage_stream(input_file, output_file):
+    """Massages and writes out every record before reading the next one"""
+    stream = open_output(output_file)
+    stream.write(MARCXML_HEADER)
+    count = 0
+    for header, record in iter_input_records(input_file):
+        record = apply_rules(header, record)
+        if header:
+            stream.write(header)
+        stream.write(record_xml_output(record))
+        count += 1
+    stream.write(MARCXML_FOOTER)
+    _print(TF.YELLOW + "Processed %d records" % (count,) + TF.END)
+
+
 if __name__ == '__main__':
     main()
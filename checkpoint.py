@@ -0,0 +1,62 @@
+"""
+Checkpoint journal for resumable harvests.
+
+After each unit of work (a record, a page) has been written to the output,
+its key and the size of the output file are appended to the journal. A
+resumed run truncates the output back to the last journalled size, which
+drops anything half-written, and skips the keys already done.
+"""
+
+import os
+
+JOURNAL_SUFFIX = '.journal'
+
+
+class Checkpoint(object):
+    """ Journal of finished work items next to an output file """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()
+        self.last = None
+        self.offset = 0
+        if resume and os.path.exists(path):
+            self._load()
+        self._handle = open(path, 'a' if resume else 'w')
+
+    def _load(self):
+        valid = 0
+        with open(self.path, 'r+') as handle:
+            for line in handle:
+                if not line.endswith('\n'):
+                    break
+                key, offset = line.rstrip('\n').rsplit('\t', 1)
+                self.done.add(key)
+                self.last = key
+                self.offset = int(offset)
+                valid += len(line)
+            # Drop a torn last line left by an interrupted write
+            handle.truncate(valid)
+
+    def restore(self, handle):
+        """ Truncates an output file opened for update to the last
+        checkpoint and moves to its end """
+        handle.seek(self.offset)
+        handle.truncate()
+
+    def record(self, key, handle):
+        """ Marks key as done once everything written to the output handle
+        so far is flushed """
+        handle.flush()
+        self.offset = handle.tell()
+        self.done.add(str(key))
+        self.last = str(key)
+        self._handle.write('%s\t%d\n' % (key, self.offset))
+        self._handle.flush()
+
+    def finish(self):
+        """ Removes the journal after a completed run """
+        self._handle.close()
+        os.remove(self.path)
+
+    def close(self):
+        self._handle.close()
@@ -0,0 +1,96 @@
+"""
+Incremental (delta) harvesting support.
+
+DeltaState remembers when each (server, query) was last harvested
+successfully, so the next run only asks for records modified since then.
+merge_collection() folds such a delta into the local collection, replacing
+records by their 001 and appending the new ones.
+"""
+
+import os
+import time
+from json import load, dump
+
+from marcxml_stream import CollectionWriter, iter_records, get_recid
+
+DEFAULT_STATE_FILE = os.path.expanduser('~/.invenio_harvest_state.json')
+# Seconds subtracted from the last harvest time to cover clock skew between
+# us and the server; records modified in the overlap are merged twice, which
+# is harmless
+OVERLAP = 3600
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class DeltaState(object):
+    """ Last successful harvest times, kept in a JSON file """
+    def __init__(self, path=DEFAULT_STATE_FILE):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.state = load(handle)
+
+    @staticmethod
+    def _key(server_url, query):
+        return '%s\t%s' % (server_url.rstrip('/'), query)
+
+    def since(self, server_url, query):
+        """ Returns the search parameters asking for records modified since
+        the last harvest of query, or None if it was never harvested """
+        started = self.state.get(self._key(server_url, query))
+        if started is None:
+            return None
+        return {'d1': time.strftime(DATE_FORMAT,
+                                    time.localtime(started - OVERLAP)),
+                'dt': 'm'}
+
+    def update(self, server_url, query, started):
+        """ Records a successful harvest of query that began at started (a
+        time.time() value) """
+        self.state[self._key(server_url, query)] = started
+        tmp_name = self.path + '.tmp'
+        with open(tmp_name, 'w') as handle:
+            dump(self.state, handle, indent=1, sort_keys=True)
+        os.rename(tmp_name, self.path)
+
+
+def merge_collection(collection_path, delta_path):
+    """ Merges the records of the MARCXML file delta_path into the one at
+    collection_path: records with a 001 found in the delta are replaced,
+    the other delta records are appended. The delta is held in memory, the
+    collection is streamed. Returns (replaced, added). """
+    delta = {}
+    order = []
+    unkeyed = []
+    with open(delta_path) as handle:
+        for xml in iter_records(handle):
+            recid = get_recid(xml)
+            if recid is None:
+                unkeyed.append(xml)
+                continue
+            if recid not in delta:
+                order.append(recid)
+            delta[recid] = xml
+
+    replaced = 0
+    tmp_name = collection_path + '.merge'
+    with open(collection_path) as handle_in:
+        with open(tmp_name, 'w') as handle_out:
+            writer = CollectionWriter(handle_out)
+            for xml in iter_records(handle_in):
+                recid = get_recid(xml)
+                if recid is not None and recid in delta:
+                    xml = delta.pop(recid)
+                    replaced += 1
+                writer.write_record(xml)
+            added = 0
+            for recid in order:
+                if recid in delta:
+                    writer.write_record(delta.pop(recid))
+                    added += 1
+            for xml in unkeyed:
+                writer.write_record(xml)
+                added += 1
+            writer.close()
+    os.rename(tmp_name, collection_path)
+    return replaced, added
@@ -0,0 +1,172 @@
+"""
+Keep-alive HTTP fetching and a bounded, order-preserving worker pool, shared
+by the harvesting scripts.
+"""
+
+import socket
+import httplib
+import threading
+from Queue import Queue, Empty
+from urlparse import urlsplit, urljoin
+
+# How many redirects are followed before giving up on a URL
+MAX_REDIRECTS = 5
+# Socket timeout for a single request, in seconds
+DEFAULT_TIMEOUT = 60
+
+
+class FetchError(IOError):
+    """ Raised when a server answers with anything other than a 200 """
+    def __init__(self, url, status, reason='', retry_after=None):
+        IOError.__init__(self, "HTTP %s %s: %s" % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class KeepAliveFetcher(object):
+    """ Fetches URLs over persistent HTTP/1.1 connections. Every thread gets
+    its own connection per host, so one fetcher can be shared by a pool of
+    worker threads. """
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._local = threading.local()
+        # Every thread's connections, for close()
+        self._all = set()
+        self._all_lock = threading.Lock()
+
+    def _connections(self):
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = {}
+        return self._local.conns
+
+    def _connection(self, scheme, netloc):
+        conns = self._connections()
+        if (scheme, netloc) not in conns:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+            with self._all_lock:
+                self._all.add(conn)
+        return conns[(scheme, netloc)]
+
+    def _drop(self, scheme, netloc):
+        conn = self._connections().pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+            with self._all_lock:
+                self._all.discard(conn)
+
+    def _request(self, scheme, netloc, path):
+        """ Sends one GET, retrying once on a fresh connection in case the
+        server silently closed the kept-alive one """
+        for attempt in (1, 2):
+            conn = self._connection(scheme, netloc)
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as exc:
+                self._drop(scheme, netloc)
+                if attempt == 2:
+                    raise IOError("Connection to %s failed: %s" % (netloc, exc))
+                continue
+            if response.will_close:
+                self._drop(scheme, netloc)
+            return response, body
+
+    def get(self, url):
+        """ Returns the body of url, raises FetchError on a non-200 status
+        and IOError if the server can't be reached """
+        for _ in xrange(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response, body = self._request(parts.scheme, parts.netloc, path)
+            if response.status in (301, 302, 303, 307):
+                url = urljoin(url, response.getheader('location'))
+                continue
+            if response.status != 200:
+                raise FetchError(url, response.status, response.reason,
+                                 response.getheader('retry-after'))
+            return body
+        raise FetchError(url, response.status, 'Too many redirects')
+
+    def close(self):
+        """ Closes the connections of every thread. Call it once the threads
+        are done; a connection used again afterwards reconnects """
+        with self._all_lock:
+            conns = list(self._all)
+        for conn in conns:
+            conn.close()
+
+
+def ordered_map(func, items, jobs=4, window=None):
+    """ Generator, calls func(item) for every item from a pool of `jobs`
+    threads and yields (item, result) in the original order of items.
+
+    At most `window` items (default: 4 * jobs) are in flight or waiting on a
+    slower predecessor, so memory stays bounded however long items is. If
+    func raises, the exception is re-raised here when its item comes up. """
+    window = window or 4 * jobs
+    tasks = Queue()
+    done = {}
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            idx, item = task
+            try:
+                outcome = (True, func(item))
+            except Exception as exc:
+                outcome = (False, exc)
+            with cond:
+                done[idx] = outcome
+                cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in xrange(max(1, jobs))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = []
+    items = iter(items)
+    try:
+        for idx, item in enumerate(items):
+            tasks.put((idx, item))
+            pending.append(item)
+            if len(pending) >= window:
+                break
+        next_idx = 0
+        while pending:
+            with cond:
+                while next_idx not in done:
+                    cond.wait(1.0)
+                success, result = done.pop(next_idx)
+            item = pending.pop(0)
+            if not success:
+                raise result
+            for new_item in items:
+                tasks.put((next_idx + len(pending) + 1, new_item))
+                pending.append(new_item)
+                break
+            next_idx += 1
+            yield item, result
+    finally:
+        # Drop work nobody is going to collect, then stop the workers
+        try:
+            while True:
+                tasks.get_nowait()
+        except Empty:
+            pass
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join(DEFAULT_TIMEOUT)
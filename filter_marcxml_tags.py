@@ -1,11 +1,103 @@
 #!/usr/bin/python
 """ Takes in MARCXML, spits it out with less tags """
 
-from sys import argv
-from invenio.bibrecord import create_records, record_xml_output
+from sys import argv, exit
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
 
 PROGRAM_NAME = argv[0].split('/')[-1]
 
+# Bytes read from the input, and collected for the output, at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+class TagFilter(object):
+    """ Copies MARCXML straight from expat's events, leaving out every
+    controlfield and datafield whose tag is not kept (the indentation in
+    front of them included). 001 is always kept, as record_xml_output does.
+    Only the current element is ever held, so memory use is constant. """
+    def __init__(self, handle, tags):
+        self.handle = handle
+        self.tags = set(tag.strip() for tag in tags) | set(['001'])
+        # Depth inside a field being left out, 0 when copying
+        self.skipping = 0
+        self.whitespace = []
+        self.out = []
+        self.size = 0
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.ordered_attributes = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.characters
+        self.parser.CommentHandler = self.comment
+
+    def write(self, text):
+        self.out.append(text)
+        self.size += len(text)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.handle.write(u''.join(self.out).encode('utf-8'))
+        self.out = []
+        self.size = 0
+
+    def flush_whitespace(self):
+        if self.whitespace:
+            self.write(u''.join(self.whitespace))
+            self.whitespace = []
+
+    def start_element(self, name, attributes):
+        if self.skipping:
+            self.skipping += 1
+            return
+        attributes = zip(attributes[::2], attributes[1::2])
+        if name.split(':')[-1] in ('controlfield', 'datafield'):
+            tag = dict(attributes).get('tag', '')
+            if tag not in self.tags:
+                self.skipping = 1
+                self.whitespace = []
+                return
+        self.flush_whitespace()
+        self.write(u'<%s%s>' % (name, u''.join(u' %s=%s' % (key, quoteattr(value))
+                                               for key, value in attributes)))
+
+    def end_element(self, name):
+        if self.skipping:
+            self.skipping -= 1
+            return
+        self.flush_whitespace()
+        self.write(u'</%s>' % (name,))
+
+    def characters(self, data):
+        if self.skipping:
+            return
+        if data.isspace():
+            self.whitespace.append(data)
+        else:
+            self.flush_whitespace()
+            self.write(escape(data))
+
+    def comment(self, data):
+        if not self.skipping:
+            self.flush_whitespace()
+            self.write(u'<!--%s-->' % (data,))
+
+    def run(self, handle_in):
+        """ Filters everything read from handle_in """
+        self.write(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+        while True:
+            chunk = handle_in.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.parser.Parse(chunk, False)
+        self.parser.Parse('', True)
+        self.flush_whitespace()
+        self.write(u'\n')
+        self.flush()
+
+
 def main():
     usage = """ Usage: $ %s [tags_csv] [marcxml_in] [marcxml_out]
   tags_csv      Tags to preserve as CSVs
@@ -19,21 +111,13 @@ def main():
         print(usage)
         return
 
-    with open(fin) as handle:
-        records = create_records(handle.read())
-
-
-    xmlout = ('<?xml version="1.0"?>\n' +
-              '<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
-
-    for record, err, reason in records:
-        if err == '0':
-            print('Error: Could not create record\n' + reason)
-        else:
-            xmlout += record_xml_output(record, tags=tags) + '\n'
-
-    with open(fout, 'w') as handle:
-        handle.write(xmlout + '</collection>\n')
+    with open(fin, 'rb') as handle_in:
+        with open(fout, 'wb') as handle_out:
+            try:
+                TagFilter(handle_out, tags).run(handle_in)
+            except expat.ExpatError as exc:
+                print('Error: Could not parse %s\n%s' % (fin, exc))
+                exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
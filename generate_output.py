@@ -5,15 +5,31 @@ import os
 import sys
 import getopt
 import tempfile
-from invenio.invenio_connector import InvenioConnector
+from urllib import urlencode
 from invenio.bibrecord import create_records, record_get_field_value, \
     create_record, record_xml_output, record_has_field, record_modify_controlfield, \
     record_add_field, record_get_field_values
 from invenio.textmarc2xmlmarc import transform_file
-import time
 
-re_matched_recid = re.compile("<!-- BibMatch-Matching-Found: (http[s]{0,1}:\/\/.*)\/record\/([0-9]*)")
-re_matched_query = re.compile("<!-- BibMatch-Matching-Criteria: (.*) -->")
+from bibmatch_parser import iter_results
+from fetchpool import KeepAliveFetcher, ordered_map
+from ratelimit import call_with_backoff, get_limiter, set_rate
+from marcxml_stream import REGEX_RECORD, get_recid
+from record_store import get_store, DEFAULT_PATH as DEFAULT_STORE
+
+# Result pairs whose candidate records are fetched together
+PREFETCH_WINDOW = 200
+# Record IDs asked for per search, one less than the records per page (at
+# most 200 in Invenio) so that a full page means there is more
+FETCH_BATCH_SIZE = 199
+FETCH_PAGE_SIZE = 200
+# Searches running at once, over all hosts
+FETCH_JOBS = 4
+# Politeness budget: requests per second sent to any one host
+DEFAULT_RATE = 2.0
+
+FETCHER = KeepAliveFetcher()
+
 re_original_record = re.compile("<controlfield tag=\"001\">([0-9]*)<\/controlfield>")
 
 def load_file(filename):
@@ -24,34 +40,88 @@ def load_file(filename):
     return res
 
 def parse_resultfile(data):
-    pairs = []
-    server_url = ""
-    for match in data:
-        orig_record = create_records(match)[0]
-        recids = re_matched_recid.findall(match)
-        print match
-        print '\n=====\n', recids
-        sys.exit(0)
-        queries = re_matched_query.findall(match)
-        pairs.append(((recids, queries), orig_record))
-    return pairs
-
-def retrieve_records(results):
-    last_url = ""
+    """ Generator, turns bibmatch_parser.iter_results() tuples into
+    ((matched (url, recid) list, queries), original record) pairs """
+    for _, recids, _, queries, xml in data:
+        orig_record = create_records(xml)[0]
+        yield ((recids, queries), orig_record)
+
+def fetch_batch(url, recids):
+    """ Fetches records recids from the server at url with one
+    "001:a or 001:b ..." search (paged if need be), returns a dict of
+    recid: MARCXML """
+    query = " or ".join("001:%s" % (recid,) for recid in recids)
+    found = {}
+    jrec = 1
+    while True:
+        search_url = "%s/search?%s" % (url, urlencode(dict(p=query, of="xm", rg=FETCH_PAGE_SIZE, jrec=jrec)))
+        xml = call_with_backoff(FETCHER.get, search_url, limiter=get_limiter(search_url))
+        page = REGEX_RECORD.findall(xml)
+        new = 0
+        for rec in page:
+            recid = get_recid(rec)
+            if recid and recid not in found:
+                found[recid] = rec
+                new += 1
+        # Past the last hit Invenio answers with the last page again
+        if len(page) < FETCH_PAGE_SIZE or not new:
+            return found
+        jrec += FETCH_PAGE_SIZE
+
+def fetch_candidates(candidates, jobs=FETCH_JOBS, store=None):
+    """ Fetches the (url, recid) candidates, grouped by host into batched
+    searches run from a pool of jobs threads. With a record_store.RecordStore,
+    stored candidates are not fetched and fetched ones are stored. Returns a
+    dict of (url, recid): create_records() tuple """
+    by_host = {}
+    for url, recid in candidates:
+        by_host.setdefault(url, set()).add(recid)
+    xml_by_candidate = {}
+    batches = []
+    for url, recids in sorted(by_host.items()):
+        if store is not None:
+            for recid, xml in store.get_many(url, recids).items():
+                xml_by_candidate[(url, recid)] = xml
+            recids = [recid for recid in recids if (url, recid) not in xml_by_candidate]
+        recids = sorted(recids)
+        for start in xrange(0, len(recids), FETCH_BATCH_SIZE):
+            batches.append((url, recids[start:start + FETCH_BATCH_SIZE]))
+    for (url, _), found in ordered_map(lambda batch: fetch_batch(*batch), batches, jobs=jobs):
+        if store is not None:
+            store.put_many(url, found.items())
+        for recid, xml in found.items():
+            xml_by_candidate[(url, recid)] = xml
+    fetched = {}
+    for candidate, xml in xml_by_candidate.items():
+        rec = create_records(xml)[0]
+        if rec[1] == 1 and rec[0]:
+            fetched[candidate] = rec
+    return fetched
+
+def retrieve_records(results, fetched=None, store=None):
+    """ Returns the records of the (url, recid) results, taken from fetched
+    (see fetch_candidates) when given, else fetched now """
+    if fetched is None:
+        fetched = fetch_candidates(results, store=store)
     records = []
-    search_params = dict(p="", of="xm")
     for url, recid in results:
-        if url != last_url:
-            server = InvenioConnector(url)
-        search_params["p"] = "001:%s" % (recid,)
-        res = server.search_with_retry(**search_params)
-	time.sleep(1.0)
-        if res != []:
-            records.append(create_records(res)[0])
+        if (url, recid) in fetched:
+            records.append(fetched[(url, recid)])
         else:
             print "Problem with record: %s" % (recid,)
     return records
 
+def windows(items, size):
+    """ Generator, yields lists of up to size consecutive items """
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
 def output_record(data, tag_list, url=""):
     out = []
     for tag_struct in tag_list:
@@ -69,22 +139,42 @@ def output_record(data, tag_list, url=""):
     out.append("\n")
     return "".join(out)
 
-def generate_output(result_pairs, tag_list_original, tag_list, original_url, nomatch=False):
-    out = []
+def generate_output(result_pairs, tag_list_original, tag_list, original_url, nomatch=False,
+                    jobs=FETCH_JOBS, store=None):
+    """ Generator, yields the output for one result pair at a time. The
+    candidates of PREFETCH_WINDOW pairs at a time are fetched together """
     count = 0
-    for results, record in result_pairs:
-        count += 1
-        out.append("Original record #%d:\n" % (count,))
-        out.append(output_record(record[0], tag_list_original, original_url))
+    for window in windows(result_pairs, PREFETCH_WINDOW):
+        fetched = {}
         if not nomatch:
-            matching_records = retrieve_records(results[0])
-            sys.stderr.write("Found matching record %s...\n" % (str(results[0]),))
-            out.append("Query: %s\n" % (results[1],))
-            out.append("Matches records:\n")
-            for match in matching_records:
-                out.append(output_record(match[0], tag_list, results[0][0][0]))
-        out.append("\n")
-    return out
+            candidates = [candidate for results, _ in window for candidate in results[0]]
+            sys.stderr.write("Fetching %d matching records...\n" % (len(candidates),))
+            fetched = fetch_candidates(candidates, jobs, store)
+        for results, record in window:
+            out = []
+            count += 1
+            out.append("Original record #%d:\n" % (count,))
+            out.append(output_record(record[0], tag_list_original, original_url))
+            if not nomatch:
+                matching_records = retrieve_records(results[0], fetched)
+                sys.stderr.write("Found matching record %s...\n" % (str(results[0]),))
+                out.append("Query: %s\n" % (results[1],))
+                out.append("Matches records:\n")
+                for match in matching_records:
+                    out.append(output_record(match[0], tag_list, results[0][0][0]))
+            out.append("\n")
+            yield "".join(out)
+
+def rate_limited(result_pairs, rate):
+    """ Passes result_pairs through, putting every server met under the
+    politeness budget of rate requests per second """
+    hosts = set()
+    for pair in result_pairs:
+        for url, _ in pair[0][0]:
+            if url not in hosts:
+                hosts.add(url)
+                set_rate(url, rate)
+        yield pair
 
 def main():
     usage = """
@@ -96,9 +186,14 @@ def main():
     -n, no match mode
     -i, specify id tag from original record
     -u, specify base URL for original record
-    """
+    -r, --rate requests per second sent to any one server (default %s)
+    -j, --jobs searches running at once (default %d)
+    --store local record store to read matching records from (default %s)
+    --no-store always download matching records
+    """ % (DEFAULT_RATE, FETCH_JOBS, DEFAULT_STORE)
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hu:i:n", ["help", "url=", "id="])
+        opts, args = getopt.getopt(sys.argv[1:], "hu:i:nr:j:", ["help", "url=", "id=", "rate=", "jobs=",
+                                                                 "store=", "no-store"])
     except getopt.GetoptError, e:
         sys.stderr.write("Error: " + str(e) + "\n")
         print usage
@@ -106,6 +201,9 @@ def main():
     original_url = ""
     id_tag = "001"
     nomatch = False
+    rate = DEFAULT_RATE
+    jobs = FETCH_JOBS
+    store_path = DEFAULT_STORE
     for opt, opt_value in opts:
         if opt in ['-h', '--help']:
             print usage
@@ -116,20 +214,31 @@ def main():
             id_tag = opt_value
         if opt in ["-n"]:
             nomatch = True
+        if opt in ['-r', '--rate']:
+            rate = float(opt_value)
+        if opt in ['-j', '--jobs']:
+            jobs = int(opt_value)
+        if opt in ['--store']:
+            store_path = opt_value
+        if opt in ['--no-store']:
+            store_path = None
 
     filename = args[0]
     match_type = filename.split('.')[-1]
     tag_list_original = [id_tag, "035", "245", "037", "100", "088", "300", "260", "773", "980"]
     tag_list = ["001", "245", "035", "100", "037", "269", "300", "773", "980"]
-    sys.stderr.write("Reading in %s...\n" % (filename,))
-    marcxml = load_file(filename)
-
     sys.stderr.write("Parsing data in %s...\n" % (filename,))
-    matches = marcxml.split('<!-- BibMatch-Matching-Results: -->\n')[1:]
-    result_pairs = parse_resultfile(matches)
-
-    out = generate_output(result_pairs, tag_list_original, tag_list, original_url, nomatch)
-    print "".join(out)
+    with open(filename) as handle:
+        result_pairs = rate_limited(parse_resultfile(iter_results(handle)), rate)
+        store = None
+        if store_path and not nomatch:
+            store = get_store(store_path)
+        for out in generate_output(result_pairs, tag_list_original, tag_list, original_url, nomatch,
+                                   jobs, store):
+            sys.stdout.write(out)
+        if store is not None:
+            sys.stderr.write(store.stats() + "\n")
+    print
 
 if __name__ == "__main__":
     main()
@@ -3,12 +3,23 @@
 from tempfile import mkstemp
 import os
 import re
-import time
 import getopt
 import sys
 import urllib2
 import urllib
+import httplib
 import getpass
+import time
+import threading
+from json import loads
+
+from fetchpool import ordered_map
+from marcxml_stream import CollectionWriter, REGEX_RECORD
+from checkpoint import Checkpoint, JOURNAL_SUFFIX
+from ratelimit import call_with_backoff, get_limiter
+from delta import DeltaState, merge_collection, DEFAULT_STATE_FILE
+from harvest_cache import HarvestCache, make_key, DEFAULT_DIRECTORY, \
+                          DEFAULT_TTL, DEFAULT_MAX_BYTES
 
 try:
     from invenio.invenio_connector import InvenioConnector, \
@@ -18,12 +29,27 @@ try:
 except ImportError:
     HAS_INVENIO = False
 
+# Errors of a search worth retrying: network and HTTP failures (URLError is
+# an IOError), and the connector giving up on an unreachable server
+RETRY_ERRORS = (IOError, httplib.HTTPException)
+if HAS_INVENIO:
+    try:
+        from invenio.invenio_connector import InvenioConnectorServerError
+        RETRY_ERRORS += (InvenioConnectorServerError,)
+    except ImportError:
+        pass
+
 regexp_datafield = re.compile("0*([1-9][0-9]*)\s([0-9]+)__\s\$\$(.*)")
 regexp_recid = re.compile("0*([1-9][0-9]*)\s[0-9]+__\s\$\$.*")
 regexp_arxiv = re.compile("0*[1-9][0-9]*\s([0-9]+)__\s.*\$\$a([^\$]*)(\$|$)??")
 regex_rec = re.compile('<record.*?>(.*?)</record>', re.DOTALL)
 regex_recid = re.compile('<record.*?>.*?<controlfield tag="001">(.*?)</controlfield>.*?</record>', re.DOTALL)
 
+# Records per search page (rg)
+PAGE_SIZE = 199
+# A delta harvest is written here before being merged into the collection
+DELTA_SUFFIX = '.delta'
+
 def retrieve_url(url):
     """
     Read all lines of given url request. Returns a list of lines.
@@ -46,54 +72,87 @@ def strip_string(s, regexp="[a-zA-Z0-9_]"):
             out.append(c)
     return "".join(out)
 
+def get_server(server_url, user="", password=""):
+    """
+    Returns an InvenioConnector for server_url, or None without Invenio.
+    """
+    if not HAS_INVENIO:
+        return None
+    if 'cds' in server_url.lower():
+        CFG_CDS_URL = "https://cdsweb.cern.ch/"
+        return CDSInvenioConnector(user=user, password=password)
+    return InvenioConnector(server_url, user=user, password=password)
+
+def search(server, server_url, search_param):
+    """
+    Runs a single search, through the connector when there is one.
+    """
+    if server is not None:
+        # ugly fix while waiting for InvenioConnector update
+        try:
+            return server.search_with_retry(**search_param)
+        except:
+            search_param = dict(search_param)
+            search_param.pop('wl', None)
+            return server.search_with_retry(**search_param)
+    full_query = "%(baseUrl)s/search?%(search)s" % {
+        "baseUrl" : server_url,
+        "search" : urllib.urlencode(search_param)
+    }
+    print full_query
+    return retrieve_url(full_query)
+
+def fetch_page(server, server_url, search_param, cache, force):
+    """
+    Returns one page of search results, from the cache unless force is set.
+    """
+    extra = dict((name, value) for name, value in search_param.items() if name not in ('p', 'of', 'c', 'jrec'))
+    key = make_key(server_url, search_param['p'], search_param['of'], search_param['c'],
+                   search_param['jrec'], **extra)
+    if not force:
+        res = cache.get(key)
+        if res is not None:
+            return res
+    res = call_with_backoff(search, server, server_url, search_param,
+                            limiter=get_limiter(server_url), retry_on=RETRY_ERRORS)
+    print "Searching %s: %s" % (server_url, search_param)
+
+    # Store cache
+    cache.put(key, res)
+    return res
+
+def get_hit_count(server, server_url, query, collection, extra=None):
+    """
+    Returns the total number of records matching query, using of=id.
+    """
+    search_param = dict(p=query, of="id", c=collection)
+    search_param.update(extra or {})
+    res = call_with_backoff(search, server, server_url, search_param,
+                            limiter=get_limiter(server_url), retry_on=RETRY_ERRORS)
+    if isinstance(res, basestring):
+        res = loads(res)
+    return len(res)
+
 def run_query(server_url, output_format, query, collection, force, ot="", \
-              limit=199, wl="", user="", password=""):
+              limit=PAGE_SIZE, wl="", user="", password="", cache=None, start=1, extra=None):
     """
     Generator function that will return search results according to the limit given,
     up till same search result is returned twice, which will cause the searching to stop.
+    extra holds any further search parameters, e.g. a modification date range.
     """
     last_result = ""
     last_recid = ""
-    i = 1
+    i = start
     if not force:
         print "Checking cache.."
-    if HAS_INVENIO:
-        if 'cds' in server_url.lower():
-            CFG_CDS_URL = "https://cdsweb.cern.ch/"
-            server = CDSInvenioConnector(user=user, password=password)
-        else:
-            server = InvenioConnector(server_url, user=user, password=password)
-    cache_filename = "/tmp/cache_%s_%s_%s_%s_%s_%d" % \
-        (server_url.split('//')[1].replace('/', '.'), strip_string(query), output_format, strip_string(ot), strip_string(collection), limit)
+    server = get_server(server_url, user, password)
+    if cache is None:
+        cache = HarvestCache()
     res = None
     while True:
-        cache_filename_full = "%s_%d" % (cache_filename, i)
-        cache_filename_full = cache_filename_full[:50]
-        if not os.path.exists(cache_filename_full) or force:
-            search_param = dict(p=query, of=output_format, ot=ot, jrec=i, rg=limit, c=collection, wl=wl)
-            if HAS_INVENIO:
-                # ugly fix while waiting for InvenioConnector update
-                try:
-                    res = server.search_with_retry(**search_param)
-                except:
-                    search_param = dict(p=query, of=output_format, ot=ot, jrec=i, rg=limit, c=collection)
-                    res = server.search_with_retry(**search_param)
-            else:
-                full_query = "%(baseUrl)s/search?%(search)s" % {
-                    "baseUrl" : server_url,
-                    "search" : urllib.urlencode(search_param)
-                }
-                res = retrieve_url(full_query)
-                print full_query
-            print "Searching %s: %s" % (server_url, search_param)
-
-            # Store cache
-            tmp_fd = open(cache_filename_full, 'w')
-            tmp_fd.write(res)
-            tmp_fd.close()
-            time.sleep(0.5)
-        else:
-            res = open(cache_filename_full).read()
+        search_param = dict(p=query, of=output_format, ot=ot, jrec=i, rg=limit, c=collection, wl=wl)
+        search_param.update(extra or {})
+        res = fetch_page(server, server_url, search_param, cache, force)
         if output_format.startswith("t"):
             # Get last line
             last_line = res.split('\n')[-2]
@@ -109,17 +168,51 @@ def run_query(server_url, output_format, query, collection, force, ot="", \
         last_result = res
         yield res
 
+def run_query_parallel(server_url, output_format, query, collection, force, ot="", \
+                       limit=PAGE_SIZE, wl="", user="", password="", jobs=4, cache=None, start=1, extra=None):
+    """
+    Generator function like run_query, but asks for the number of hits first and
+    then fetches every page from a pool of jobs threads, yielding them in order.
+    All threads share the server's rate limiter, so jobs only bounds concurrency.
+    Unlike run_query no duplicate page is returned at the end.
+    """
+    if not force:
+        print "Checking cache.."
+    local = threading.local()
+    def fetch(jrec):
+        if not hasattr(local, 'server'):
+            local.server = get_server(server_url, user, password)
+        search_param = dict(p=query, of=output_format, ot=ot, jrec=jrec, rg=limit, c=collection, wl=wl)
+        search_param.update(extra or {})
+        return fetch_page(local.server, server_url, search_param, cache, force)
+
+    if cache is None:
+        cache = HarvestCache()
+    hits = get_hit_count(get_server(server_url, user, password), server_url, query, collection, extra)
+    print "Found %d hits, fetching %d pages" % (hits, (hits + limit - 1) // limit)
+    for jrec, res in ordered_map(fetch, xrange(start, hits + 1, limit), jobs=jobs):
+        yield res
+
 def main():
     usage = """
-    harvest.py [-f of] [-t ot] [-q query] [-s url] [-c collection] [-x] [--user] [-w 1/0]
+    harvest.py [-f of] [-t ot] [-q query] [-s url] [-c collection] [-x] [--user] [-w 1/0] [-P jobs]
 
     -x will skip cache files
+    --cache-dir directory of the page cache (default %s)
+    --cache-ttl seconds before a cached page is refetched, 0 for never (default %d)
+    --cache-size size in MB the cache may grow to before old pages are evicted (default %d)
+    -P, --parallel get the number of hits first, then fetch pages from this many threads
+    -o, --output file to write the harvest to (default: a new file in /tmp)
+    --resume continue an interrupted harvest into the file given with -o
+    --delta only get records modified since the last harvest of this query and
+            merge them into the collection given with -o (MARCXML only)
+    --state-file where --delta keeps the last harvest times (default %s)
 
     Example:
     $ python harvest.py -q "ellis" -f 'xm' -s 'http:://inspirebeta.net' -c 'HEP' --user admin
-    """
+    """ % (DEFAULT_DIRECTORY, DEFAULT_TTL, DEFAULT_MAX_BYTES // (1024 * 1024), DEFAULT_STATE_FILE)
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hf:t:q:s:c:xw", ['user='])
+        opts, args = getopt.getopt(sys.argv[1:], "hf:t:q:s:c:xwP:o:", ['user=', 'parallel=', 'output=', 'resume', 'delta', 'state-file=', 'cache-dir=', 'cache-ttl=', 'cache-size='])
     except getopt.GetoptError, e:
         sys.stderr.write("Error:" + str(e) + "\n")
         print usage
@@ -134,6 +227,14 @@ def main():
     wl = ""
     user = ""
     password = ""
+    parallel = 0
+    cache_dir = DEFAULT_DIRECTORY
+    cache_ttl = DEFAULT_TTL
+    cache_size = DEFAULT_MAX_BYTES
+    output = ""
+    resume = False
+    delta = False
+    state_file = DEFAULT_STATE_FILE
     for opt, opt_value in opts:
         if opt in ['-f']:
             of = opt_value
@@ -152,35 +253,119 @@ def main():
         if opt in ['--user']:
             user = opt_value
             password = getpass.getpass()
+        if opt in ['-P', '--parallel']:
+            parallel = int(opt_value)
+        if opt in ['--cache-dir']:
+            cache_dir = opt_value
+        if opt in ['--cache-ttl']:
+            cache_ttl = int(opt_value)
+        if opt in ['--cache-size']:
+            cache_size = int(opt_value) * 1024 * 1024
+        if opt in ['-o', '--output']:
+            output = opt_value
+        if opt in ['--resume']:
+            resume = True
+        if opt in ['--delta']:
+            delta = True
+        if opt in ['--state-file']:
+            state_file = opt_value
         if opt in ['-h']:
             print usage
             sys.exit(0)
 
-    i = 0
-    results = []
-    regex = re.compile('<collection.*?>(.*)</collection>', re.DOTALL)
-    regex_rec = re.compile('<record.*?>.*?</record>', re.DOTALL)
-    for result in run_query(server_url, of, query, collection, force, ot=ot, wl=wl, user=user, password=password):
-        if of == "xm":
-            result = regex.findall(result)[0]
-        results.append(result)
-        i += 1
+    if resume and not output:
+        sys.stderr.write("Error: --resume needs the output file of the interrupted harvest (-o)\n")
+        sys.exit(1)
+    if delta and (not output or of != "xm"):
+        sys.stderr.write("Error: --delta needs a MARCXML collection to merge into (-f xm -o file)\n")
+        sys.exit(1)
 
-    if of == "xm":
-        if len(results) == 1:
-            total_result = "<collection xmlns=\"http://www.loc.gov/MARC21/slim\">" + "".join(results) + "</collection>\n"
+    started = time.time()
+    delta_params = None
+    if delta:
+        state = DeltaState(state_file)
+        if os.path.exists(output):
+            delta_params = state.since(server_url, query)
+        if delta_params:
+            print "Getting records modified since %s" % (delta_params['d1'],)
+            output += DELTA_SUFFIX
         else:
-            total_result = "<collection xmlns=\"http://www.loc.gov/MARC21/slim\">" + "".join(results[:-1]) + "</collection>\n"
-        num_rec = len(regex_rec.findall(total_result))
+            print "No previous harvest of this query, getting everything"
+
+    if output:
+        out_name = output
+        out_handle = open(output, 'r+' if resume and os.path.exists(output) else 'w')
+    else:
+        out_fd, out_name = mkstemp(".dat", "harvest_%s_%s_" % (strip_string(server_url), strip_string(query[:50])))
+        out_handle = os.fdopen(out_fd, 'w')
+    checkpoint = Checkpoint(out_name + JOURNAL_SUFFIX, resume)
+    checkpoint.restore(out_handle)
+    start = 1
+    if checkpoint.last is not None:
+        start = int(checkpoint.last) + PAGE_SIZE
+        print "Resuming from record %d, %d pages already harvested" % (start, len(checkpoint.done))
+
+    cache = HarvestCache(cache_dir, cache_ttl, cache_size)
+    if parallel:
+        pages_found = run_query_parallel(server_url, of, query, collection, force, ot=ot, wl=wl, user=user, password=password, jobs=parallel, cache=cache, start=start, extra=delta_params)
     else:
-        total_result = "".join(results)
-        recids = regexp_recid.findall(total_result)
-        num_rec = len(set(recids))
+        pages_found = run_query(server_url, of, query, collection, force, ot=ot, wl=wl, user=user, password=password, cache=cache, start=start, extra=delta_params)
+    try:
+        num_rec = write_results(pages_found, of, out_handle, checkpoint, start, parallel)
+    except:
+        checkpoint.close()
+        out_handle.close()
+        print "Harvest interrupted, continue it with: -o %s --resume" % (out_name,)
+        raise
+    checkpoint.finish()
+    out_handle.close()
+    print cache.stats()
     print "Found %d records" % (num_rec,)
-    out_fd, out_name = mkstemp(".dat", "harvest_%s_%s_" % (strip_string(server_url), strip_string(query[:50])))
-    os.write(out_fd, total_result)
-    os.close(out_fd)
+    if delta_params:
+        out_name = out_name[:-len(DELTA_SUFFIX)]
+        replaced, added = merge_collection(out_name, output)
+        os.remove(output)
+        print "Merged into %s: %d records replaced, %d added" % (out_name, replaced, added)
+    if delta:
+        state.update(server_url, query, started)
     print "Harvest completed. Find results here: %s" % (out_name,)
 
+def write_results(pages_found, of, out_handle, checkpoint, start, parallel):
+    """
+    Streams harvested pages to out_handle, journalling each written page in
+    checkpoint. Returns the number of records written.
+    """
+    regex = re.compile('<collection.*?>(.*)</collection>', re.DOTALL)
+    num_rec = 0
+    jrec = start
+    pages = len(checkpoint.done)
+    if of == "xm":
+        # Pages are written one behind the search, the final page returned
+        # by run_query repeats the end of the result set and is dropped
+        # unless it is the only one.
+        writer = CollectionWriter(out_handle, declaration=False, header=not checkpoint.offset)
+        pending = None
+        for result in pages_found:
+            if pending is not None:
+                writer.write_raw(pending)
+                num_rec += len(REGEX_RECORD.findall(pending))
+                checkpoint.record(jrec - PAGE_SIZE, out_handle)
+            pending = regex.findall(result)[0]
+            jrec += PAGE_SIZE
+            pages += 1
+        if pending is not None and (pages == 1 or parallel):
+            writer.write_raw(pending)
+            num_rec += len(REGEX_RECORD.findall(pending))
+        writer.close()
+    else:
+        recids = set()
+        for result in pages_found:
+            out_handle.write(result)
+            recids.update(regexp_recid.findall(result))
+            checkpoint.record(jrec, out_handle)
+            jrec += PAGE_SIZE
+        num_rec = len(recids)
+    return num_rec
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,155 @@
+"""
+Content-addressed on-disk cache for harvested search pages.
+
+Entries are named after a SHA-1 of everything that identifies a page, stored
+zlib compressed, expire after a TTL and are evicted least recently used
+first once the cache grows past its byte budget.
+"""
+
+import os
+import zlib
+import time
+import hashlib
+import tempfile
+import threading
+
+DEFAULT_DIRECTORY = '/tmp/harvest_cache'
+# Seconds before an entry is considered stale, 0 never expires
+DEFAULT_TTL = 7 * 24 * 3600
+# Size of the cache on disk before old entries are evicted
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Eviction frees space down to this fraction of the budget
+EVICT_TO = 0.9
+
+ENTRY_SUFFIX = '.z'
+
+
+def make_key(server_url, query, output_format, collection, offset, **extra):
+    """ Returns the cache key of a search page. Any other search parameter
+    that changes the page (ot, rg, ...) should be given as a keyword. """
+    parts = [server_url, query, output_format, collection, str(offset)]
+    parts += ['%s=%s' % (name, value) for name, value in sorted(extra.items())]
+    text = '\0'.join(parts)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+class HarvestCache(object):
+    """ Cache of harvested pages keyed by make_key(). Safe to share between
+    threads; hit/miss counters are kept for stats(). """
+    def __init__(self, directory=DEFAULT_DIRECTORY, ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def _entries(self):
+        """ Lists (last access, size, path) of every entry on disk """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+        return entries
+
+    def _remove(self, path, size):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        if self._size is not None:
+            self._size -= size
+
+    def get(self, key):
+        """ Returns the cached page for key, or None """
+        path = self._path(key)
+        now = time.time()
+        # Read under the lock so that another thread's eviction cannot
+        # remove the entry in between
+        with self._lock:
+            try:
+                stat = os.stat(path)
+                if self.ttl and now - stat.st_mtime > self.ttl:
+                    self._remove(path, stat.st_size)
+                    self.expired += 1
+                    self.misses += 1
+                    return None
+                with open(path, 'rb') as handle:
+                    payload = handle.read()
+                # Access time drives LRU eviction, set it ourselves for
+                # noatime mounts
+                os.utime(path, (now, stat.st_mtime))
+            except (IOError, OSError):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return zlib.decompress(payload)
+
+    def put(self, key, data):
+        """ Stores data under key, evicting old entries if over budget """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        payload = zlib.compress(data)
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        tmp_fd, tmp_name = tempfile.mkstemp(ENTRY_SUFFIX + '.tmp',
+                                            dir=os.path.dirname(path))
+        os.write(tmp_fd, payload)
+        os.close(tmp_fd)
+        with self._lock:
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.rename(tmp_name, path)
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(payload) - replaced
+            if self.max_bytes and self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """ Drops least recently used entries until under the budget """
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TO
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            self._remove(path, size)
+            self.evicted += 1
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            for _, size, path in self._entries():
+                self._remove(path, size)
+            self._size = 0
+
+    def stats(self):
+        return ("Cache %s: %d hits, %d misses (%d expired), %d evicted" %
+                (self.directory, self.hits, self.misses, self.expired,
+                 self.evicted))
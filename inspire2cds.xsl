@@ -32,6 +32,14 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
 <xsl:variable name="numbers" select="'0123456789'"/>
 <xsl:variable name="symbols" select="'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-. '" />
 
+<!-- Knowledge base indexes: key() hashes a KB the first time it is used on it
+     instead of every lookup scanning the whole KB. Keys may not use variables,
+     hence the spelt out alphabets -->
+<xsl:key name="experiments-693" match="experiments/experiment/inspire"
+         use="translate(translate(., '-', ''), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')" />
+<xsl:key name="journal-titles" match="mappings/journal-title/inspire" use="translate(., ' ', '')" />
+<xsl:key name="categories-65017" match="categories/category" use="inspire" />
+
 <!-- ************ FUNCTIONS ************ -->
 
 <!-- FUNCTION   output-65017a-subfields -->
@@ -51,7 +59,10 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
   <xsl:if test="$text != ''">
     <xsl:variable name="newexp" select="translate($text, $numbers, '')" />
     <xsl:variable name="newnum" select="translate($text, $symbols, '')" />
-    <xsl:variable name="nodes" select="document('cds_inspire_693.xml')/experiments/experiment/inspire[translate(translate(., '-', ''), $uppercase, $smallcase) = translate(translate($newexp, '-', ''), $uppercase, $smallcase)]"/>
+    <xsl:variable name="experiment" select="translate(translate($newexp, '-', ''), $uppercase, $smallcase)" />
+    <!-- key() looks in the document of the context node -->
+    <xsl:for-each select="document('cds_inspire_693.xml')">
+    <xsl:variable name="nodes" select="key('experiments-693', $experiment)"/>
       <xsl:choose>
         <xsl:when test="$nodes != ''">
           <datafield tag="693" ind1=" " ind2=" ">
@@ -66,6 +77,7 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
           </datafield>
         </xsl:otherwise>
       </xsl:choose>
+    </xsl:for-each>
   </xsl:if>
 </xsl:template>
 
@@ -75,7 +87,9 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
     <xsl:param name="volume" />
     <xsl:if test="$title != ''">
       <xsl:variable name="newvolume" select="translate($volume, $numbers, '')" />
-      <xsl:variable name="nodes" select="document('cds_inspire_journal_abbreviations.xml')/mappings/journal-title/inspire[translate(., ' ', '') = translate($title, ' ', '')]"/>
+      <xsl:variable name="journal" select="translate($title, ' ', '')" />
+      <xsl:for-each select="document('cds_inspire_journal_abbreviations.xml')">
+      <xsl:variable name="nodes" select="key('journal-titles', $journal)"/>
       <xsl:variable name="newtitle">
           <xsl:for-each select="str:split($nodes/preceding-sibling::*[1], ' ')">
               <xsl:if test="not(position() = last() and string-length(.) = 1)">
@@ -98,6 +112,7 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
           <xsl:value-of select="$title" />
         </xsl:otherwise>
       </xsl:choose>
+      </xsl:for-each>
     </xsl:if>
   </xsl:template>
 
@@ -178,12 +193,11 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
   <xsl:template name="translate-categories">
     <xsl:param name="text"/>
     <xsl:if test="$text != ''">
-      <xsl:variable name="kb" select="document('cds_inspire_categories_65017.xml')/categories"/>
       <xsl:variable name="newcat">
-        <xsl:for-each select="$kb/category">
-          <xsl:if test="./inspire=$text">
+        <xsl:for-each select="document('cds_inspire_categories_65017.xml')">
+          <xsl:for-each select="key('categories-65017', $text)">
             <xsl:value-of select="./cds" />
-          </xsl:if>
+          </xsl:for-each>
         </xsl:for-each>
       </xsl:variable>
       <xsl:choose>
@@ -263,6 +277,8 @@ along with CDS Invenio; if not, write to the Free Software Foundation, Inc.,
   <xsl:template name="translate-language">
     <xsl:param name="text"/>
     <xsl:if test="$text != ''">
+      <!-- Every entry containing the name, not only an exact match, so this
+           KB (a few entries) is scanned rather than indexed -->
       <xsl:variable name="kb" select="document('cds_inspire_languages.xml')/languages"/>
       <xsl:variable name="newlang">
         <xsl:for-each select="$kb/language">
@@ -2,35 +2,139 @@
 # -*- coding: utf-8 -*-
 
 
-""" Deletes records from a local Invenio instance """
+""" Deletes records from a local Invenio instance
 
+Usage: $ python invenio-delete-records.py [-n] [start end | -f recid_file]
 
-from invenio.search_engine import get_record
+Without arguments the range of record IDs is asked for. Which of the records
+exist is found with one query (a few for a long recid file), and those are
+queued for BibUpload with only their 001.
+
+ -f, --recid-file  delete the record IDs listed in a file, one per line
+ -n, --dry-run     only tell what would be deleted
+"""
+
+import sys
+import time
+import getopt
+
+from invenio.dbquery import run_sql
 from invenio.bibtaskutils import ChunkedBibUpload
-from invenio.bibrecord import record_xml_output
 
 
-bibupload = ChunkedBibUpload(mode='d', user='admin', notimechange=True)
+DELETION_MARCXML = '<record><controlfield tag="001">%d</controlfield></record>'
+# Record IDs looked up per query when they come from a file
+QUERY_BATCH_SIZE = 1000
+
+
+def read_recid_file(path):
+    """ Returns the set of record IDs listed in the file at path, one per
+    line; blank lines and lines starting with # are skipped. Exits on a line
+    that is not a record ID """
+    recids = set()
+    with open(path) as handle:
+        for line_number, line in enumerate(handle, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                recids.add(int(line))
+            except ValueError:
+                print "Error: %s, line %d: %r is not a record ID" % (path, line_number, line)
+                sys.exit(1)
+    return recids
+
+
+def existing_recids(start, end):
+    """ Returns the set of record IDs from start to end (both included) that
+    exist, with a single query """
+    return set(row[0] for row in run_sql("SELECT id FROM bibrec WHERE id BETWEEN %s AND %s",
+                                         (start, end)))
+
+
+def existing_listed_recids(recids):
+    """ Returns the set of the record IDs of recids that exist, querying
+    QUERY_BATCH_SIZE of them at a time """
+    recids = sorted(recids)
+    found = set()
+    for start in xrange(0, len(recids), QUERY_BATCH_SIZE):
+        batch = recids[start:start + QUERY_BATCH_SIZE]
+        found.update(row[0] for row in run_sql(
+            "SELECT id FROM bibrec WHERE id IN (%s)" % (','.join(['%s'] * len(batch)),),
+            tuple(batch)))
+    return found
+
+
+def queue_deletions(recids):
+    """ Adds the 001-only MARCXML of every record of recids to a BibUpload
+    task """
+    bibupload = ChunkedBibUpload(mode='d', user='admin', notimechange=True)
+    for recid in sorted(recids):
+        bibupload.add(DELETION_MARCXML % (recid,))
+    bibupload.__del__()
+
+
+def ask_range():
+    """ Asks for the range of record IDs, returns (start, end) """
+    print "Enter range of record IDs to be deleted:"
+    print "Start: "
+    range_start = int(raw_input())
+    print "End: "
+    range_end = int(raw_input())
+    return range_start, range_end
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hf:n", ["help", "recid-file=", "dry-run"])
+    except getopt.GetoptError as err:
+        print "Error: %s" % (err,)
+        print __doc__
+        sys.exit(1)
+    recid_file = None
+    dry_run = False
+    for opt, opt_value in opts:
+        if opt in ['-h', '--help']:
+            print __doc__
+            sys.exit(0)
+        if opt in ['-f', '--recid-file']:
+            recid_file = opt_value
+        if opt in ['-n', '--dry-run']:
+            dry_run = True
 
+    print "Invenio record deleter!"
+    if recid_file:
+        wanted = read_recid_file(recid_file)
+        if not wanted:
+            print "No record IDs in %s" % (recid_file,)
+            return
+    else:
+        if len(args) == 2:
+            range_start, range_end = int(args[0]), int(args[1])
+        else:
+            range_start, range_end = ask_range()
+        wanted = None
 
-print "Invenio record deleter!"
-print "Enter range of record IDs to be deleted:"
-print "Start: "
-range_start = int(raw_input())
-print "End: "
-range_end = int(raw_input()) + 1
+    print " ========== Let's do this! =========="
 
-print " ========== Let's do this! =========="
+    begin = time.time()
+    if wanted is not None:
+        recids = existing_listed_recids(wanted)
+        missing = len(wanted) - len(recids)
+    else:
+        recids = existing_recids(range_start, range_end)
+        missing = max(0, range_end - range_start + 1) - len(recids)
+    print "%d records to delete, %d not in there (found in %.2fs)" % (
+        len(recids), missing, time.time() - begin)
+    if not recids:
+        return
+    if dry_run:
+        print "Dry run: would delete records %d to %d" % (min(recids), max(recids))
+        return
 
-for recid in range(range_start, range_end):
-	record = get_record(recid)
-	if record:
-		marc = record_xml_output(record, tags=list('001'))
-		bibupload.add(marc)
-		print "%s: Got it!" % str(recid)
-	else:
-		print "%s: It's not in there!" % str(recid)
+    queue_deletions(recids)
+    print "BibUpload task added to BibSched... go run it to finish!"
 
-print "BibUpload task added to BibSched... go run it to finish!"
 
-bibupload.__del__()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -3,21 +3,35 @@ Harvests docs from an Inspire instance;
 Graham R. Armstrong, July 2013
 """
 
-import re
+import os
 import sys
 import argparse
 from json import loads
-from time import sleep
-from urllib import urlencode, urlopen
+from time import time
+from urllib import urlencode
 from argparse import ArgumentParser
 #from xml.etree import ElementTree
 
+from fetchpool import KeepAliveFetcher, ordered_map
+from marcxml_stream import CollectionWriter, REGEX_RECORD
+from record_store import get_store, DEFAULT_PATH as DEFAULT_STORE
+from checkpoint import Checkpoint, JOURNAL_SUFFIX
+from ratelimit import call_with_backoff, get_limiter
+from delta import DeltaState, merge_collection, DEFAULT_STATE_FILE
+
 # ARGUMENTS
 CONF = {}
 
 # CONSTANTS
 MAX_ATTEMPTS = 5
+# Longest wait between two attempts, the actual wait backs off up to this
 SLEEP_TIME = 60
+# Number of records downloaded in parallel
+DEFAULT_JOBS = 4
+# A delta harvest is written here before being merged into the output
+DELTA_SUFFIX = '.delta'
+
+FETCHER = KeepAliveFetcher()
 
 
 class ArgumentsProvidedError(ValueError):
@@ -30,9 +44,10 @@ def clear_namespace(xml):
         clear_namespace(element)
 
 
-def compile_url(search_term_raw, of='xm', fields=None):
+def compile_url(search_term_raw, of='xm', fields=None, extra=None):
     f = {'ln': 'en', 'of': of, 'action_search': 'Search',
          'p': search_term_raw, 'f': fields}
+    f.update(extra or {})
     p = urlencode(f)
     uri = '%s/search?%s' % (CONF['url'], p)
     return uri
@@ -40,19 +55,11 @@ def compile_url(search_term_raw, of='xm', fields=None):
 
 def get_contents(url):
     print 'Handle: ' + url
-    attempts = 0
-    while attempts < MAX_ATTEMPTS:
-        attempts += 1
-        try:
-            handle = urlopen(url)
-            content = handle.read()
-            handle.close()
-            return content
-        except IOError:
-            print 'HTTP Error, retrying in %ds (Attempt %d)' % (SLEEP_TIME,
-                                                                attempts)
-            sleep(SLEEP_TIME)
-    print "ERROR: Could not get contents of URL: %s" % url
+    try:
+        return call_with_backoff(FETCHER.get, url, limiter=get_limiter(url),
+                                 attempts=MAX_ATTEMPTS, cap=SLEEP_TIME)
+    except IOError:
+        print "ERROR: Could not get contents of URL: %s" % url
 
 
 # Legacy
@@ -79,28 +86,87 @@ def get_contents(url):
 #     return ElementTree.tostring(collection)
 
 
-def get_many_records(domain, recids):
+def fetch_record(url):
+    """ Downloads a single record over the worker's kept-alive connection,
+    going through the host's rate limiter and backing off on errors """
+    return call_with_backoff(FETCHER.get, url, limiter=get_limiter(url),
+                             attempts=MAX_ATTEMPTS, cap=SLEEP_TIME)
+
+
+def get_many_records(domain, recids, handle, jobs=DEFAULT_JOBS,
+                     checkpoint=None, store=None, refresh=False):
     """ Given a list of record IDs, attempts to download records from
-    a remote server, reformed to avoid using Etree """
-    xml_col = '<?xml version="1.0" encoding="UTF-8"?>\n<collection xmlns="http://www.loc.gov/MARC21/slim">\n'
-    regex = re.compile('<record.*?>.*?</record>', re.DOTALL)
-    for idx, _id in enumerate(recids, 1):
-        rec_id = str(_id)
-        print "%d) Getting record #%s" % (idx, rec_id)
-        url = "%s/record/%s/export/xm" % (domain, rec_id)
-        handle = urlopen(url)
-        xml_out = handle.read()
-        handle.close()
-        for xmlrec in regex.findall(xml_out):
-            xml_col += xmlrec + '\n'
-    xml_col += '</collection>\n'
-    return xml_col
-
-
-def search_for_ids():
-    """ Performs search, returns a list of record IDs """
+    a remote server, reformed to avoid using Etree. Records are fetched by
+    a pool of `jobs` threads and streamed to handle in the order of recids
+    as they arrive; returns the number of records written.
+
+    With a checkpoint, recids it has already done are skipped, the partial
+    collection in handle is appended to and every written record is
+    journalled.
+
+    With a record_store.RecordStore, records found there are not downloaded
+    and downloaded ones are kept in it; refresh downloads them all anyway
+    (e.g. when they are known to have changed) """
+    if checkpoint:
+        checkpoint.restore(handle)
+        if checkpoint.done:
+            print "Resuming, %d records already harvested" % len(checkpoint.done)
+        recids = [_id for _id in recids if str(_id) not in checkpoint.done]
+    writer = CollectionWriter(handle,
+                              header=not (checkpoint and checkpoint.offset))
+
+    def fetch(rec_id):
+        if store is not None and not refresh:
+            xml_out = store.get(domain, rec_id)
+            if xml_out is not None:
+                return xml_out
+        xml_out = fetch_record("%s/record/%s/export/xm" % (domain, rec_id))
+        if store is not None:
+            records = REGEX_RECORD.findall(xml_out)
+            if len(records) == 1:
+                store.put(domain, rec_id, records[0])
+        return xml_out
+
+    for idx, (rec_id, xml_out) in enumerate(ordered_map(fetch, recids,
+                                                        jobs=jobs), 1):
+        print "%d) Got record #%s" % (idx, rec_id)
+        writer.write_records_from(xml_out)
+        if checkpoint:
+            checkpoint.record(rec_id, handle)
+    writer.close()
+    return writer.count
+
+
+def open_output(path, resume=False):
+    """ Opens the output file for writing, falling back to a file in /tmp
+    and then to StdOut. When resuming an existing file is opened for update
+    instead of being emptied """
+    def open_file(name):
+        if resume and os.path.exists(name):
+            return open(name, 'r+')
+        return open(name, 'w')
+
+    print "Writing results to %s" % (path,)
+    try:
+        return open_file(path)
+    except IOError as exc:
+        print exc
+    try:
+        tmp_file = '/tmp/harvest_' + path.split('/')[-1] + '_safe.xml'
+        print "Writing results to %s" % (tmp_file,)
+        return open_file(tmp_file)
+    except IOError as exc2:
+        print exc2
+        print "ERROR: Can't write to file, outputting to StdOut\n\n\n"
+        return sys.stdout
+
+
+def search_for_ids(extra=None):
+    """ Performs search, returns a list of record IDs. extra holds any
+    further search parameters, e.g. a modification date range """
     print 'Gettings records from %s matching terms: %s' % (CONF['url'], CONF['search_terms'])
-    url = compile_url(CONF['search_terms'], of='id', fields=CONF['fields'])
+    url = compile_url(CONF['search_terms'], of='id', fields=CONF['fields'],
+                      extra=extra)
     ids_str = get_contents(url)
     print ids_str
     record_ids = loads(ids_str)
@@ -116,6 +182,18 @@ records as MARCXML to a directed .xml file."""
     parser.add_argument('-p', '--search-terms', help="Search terms to use while searching for records.")
     parser.add_argument('-f', '--fields', help="Fields to search in (e.g. title)", default='')
     parser.add_argument('-i', '--ids', help="A comma seperated list of record IDs to fetch (CSVs)")
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                        help="Number of records to download in parallel (default %d)" % DEFAULT_JOBS)
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted harvest into the same output file")
+    parser.add_argument('--delta', action='store_true',
+                        help="Only get records modified since the last harvest of these search terms and merge them into output_file")
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE,
+                        help="Where --delta keeps the last harvest times (default %s)" % DEFAULT_STATE_FILE)
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help="Local record store records are taken from and kept in (default %s)" % DEFAULT_STORE)
+    parser.add_argument('--no-store', action='store_true',
+                        help="Download every record and keep none in the local record store")
     parser.add_argument('output_file', help="The file to output to.")
     arghs = vars(parser.parse_args())
 
@@ -134,37 +212,73 @@ records as MARCXML to a directed .xml file."""
     else:
         CONF['url'] = "http://" + arghs['remote_server']
     CONF['output'] = arghs['output_file']
+    CONF['jobs'] = max(1, arghs['jobs'])
+    CONF['resume'] = arghs['resume']
+    CONF['delta'] = arghs['delta']
+    store = None
+    if not arghs['no_store']:
+        store = get_store(arghs['store'])
 
-    if 'ids' in CONF:
-        print "Getting records from IDs"
-        content = get_many_records(CONF['url'], CONF['ids'])
-    else:
-        record_ids = search_for_ids()
-        print "Getting %d records..." % (len(record_ids),)
-        if len(record_ids) > 10:
-            content = get_many_records(CONF['url'], record_ids)
+    started = time()
+    delta_params = None
+    if CONF['delta']:
+        if 'search_terms' not in CONF:
+            raise ArgumentsProvidedError("ERROR: Delta harvesting needs search terms (-p)")
+        state = DeltaState(arghs['state_file'])
+        if os.path.exists(CONF['output']):
+            delta_params = state.since(CONF['url'], CONF['search_terms'])
+        if delta_params:
+            print "Getting records modified since %s" % (delta_params['d1'],)
         else:
-            url = compile_url(CONF['search_terms'], fields=CONF['fields'])
-            ham_handle = urlopen(url)
-            content = ham_handle.read()
-            ham_handle.close()
+            print "No previous harvest of these search terms, getting everything"
 
-    path = CONF['output']
-    print "Writing results to %s" % (path,)
+    if delta_params:
+        handle = open_output(CONF['output'] + DELTA_SUFFIX, CONF['resume'])
+    else:
+        handle = open_output(CONF['output'], CONF['resume'])
+    checkpoint = None
+    if handle is not sys.stdout:
+        checkpoint = Checkpoint(handle.name + JOURNAL_SUFFIX, CONF['resume'])
     try:
-        with open(path, 'w') as filehandle:
-            filehandle.write(content)
-    except IOError as exc:
-        print exc
-        try:
-            tmp_file = '/tmp/harvest_' + CONF['output'].split('/')[-1] + '_safe.xml'
-            print "Writing results to %s" % (tmp_file,)
-            with open(tmp_file, 'w') as han2:
-                han2.write(content)
-        except IOError as exc2:
-            print exc2
-            print "ERROR: Can't write to file, outputting to StdOut\n\n\n"
-            print content
+        if 'ids' in CONF:
+            print "Getting records from IDs"
+            get_many_records(CONF['url'], CONF['ids'], handle, CONF['jobs'],
+                             checkpoint, store)
+        else:
+            record_ids = search_for_ids(delta_params)
+            print "Getting %d records..." % (len(record_ids),)
+            if len(record_ids) > 10:
+                # Records of a delta have changed, so stored copies are stale
+                get_many_records(CONF['url'], record_ids, handle,
+                                 CONF['jobs'], checkpoint, store,
+                                 refresh=bool(delta_params))
+            else:
+                url = compile_url(CONF['search_terms'], fields=CONF['fields'],
+                                  extra=delta_params)
+                if CONF['resume'] and handle is not sys.stdout:
+                    handle.truncate(0)
+                handle.write(get_contents(url))
+    except:
+        if checkpoint:
+            checkpoint.close()
+            print "Harvest interrupted, continue it with --resume"
+        raise
+    else:
+        if checkpoint:
+            checkpoint.finish()
+        if store is not None:
+            print store.stats()
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+    if delta_params and handle is not sys.stdout:
+        replaced, added = merge_collection(CONF['output'], handle.name)
+        os.remove(handle.name)
+        print "Merged into %s: %d records replaced, %d added" % (
+            CONF['output'], replaced, added)
+    if CONF['delta'] and handle is not sys.stdout:
+        state.update(CONF['url'], CONF['search_terms'], started)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""
+Local stand-in for an Invenio instance, serving a synthetic corpus so the
+harvesters can be tested and benchmarked without hitting inspirebeta.net or
+cdsweb.
+
+Serves:
+ /search?p=..&of=xm|id|tm&jrec=..&rg=..&d1=..&dt=m
+ /record/<recid>/export/xm
+
+Queries are mostly ignored (every record matches) except for terms such as
+"001:12 or recid:13 or 970:SPIRES-5", which select records. jrec past the
+end of the hits returns the last page, like Invenio does, and d1/dt=m
+filter on the modification date (005) of the records.
+
+Usage: $ python invenio_standin.py [--port 8080] [--records 10000]
+                                   [--latency 0.05] [--error-rate 0.01]
+"""
+
+import re
+import sys
+import time
+import random
+import threading
+from json import dumps
+from argparse import ArgumentParser
+from urlparse import urlsplit, parse_qsl
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_PORT = 8080
+DEFAULT_RECORDS = 10000
+# Records are modified one every MODIFIED_STEP seconds up to "now"
+MODIFIED_STEP = 60
+# Invenio's default and maximum page sizes
+DEFAULT_RG = 10
+MAX_RG = 200
+
+RE_TERM = re.compile(r'^(001|recid|970)\s*:\s*"?([^"\s]+)"?$', re.IGNORECASE)
+
+MARCXML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                 '<collection xmlns="http://www.loc.gov/MARC21/slim">\n'
+MARCXML_FOOTER = '</collection>\n'
+
+RECORD_TEMPLATE = """<record>
+  <controlfield tag="001">%(recid)d</controlfield>
+  <controlfield tag="005">%(modified)s.0</controlfield>
+  <datafield tag="035" ind1=" " ind2=" ">
+    <subfield code="9">SPIRES</subfield>
+    <subfield code="a">%(sysno)d</subfield>
+  </datafield>
+  <datafield tag="037" ind1=" " ind2=" ">
+    <subfield code="a">arXiv:1307.%(recid)05d</subfield>
+  </datafield>
+  <datafield tag="100" ind1=" " ind2=" ">
+    <subfield code="a">Author, %(recid)d.</subfield>
+  </datafield>
+  <datafield tag="245" ind1=" " ind2=" ">
+    <subfield code="a">Synthetic record number %(recid)d</subfield>
+  </datafield>
+  <datafield tag="773" ind1=" " ind2=" ">
+    <subfield code="p">Phys.Rev.</subfield>
+    <subfield code="v">%(volume)d</subfield>
+  </datafield>
+  <datafield tag="970" ind1=" " ind2=" ">
+    <subfield code="a">SPIRES-%(sysno)d</subfield>
+  </datafield>
+  <datafield tag="980" ind1=" " ind2=" ">
+    <subfield code="a">HEP</subfield>
+  </datafield>
+</record>"""
+
+
+class Corpus(object):
+    """ Synthetic records 1..size, generated on demand. Record N has SPIRES
+    sysno N + 1000000 and was last modified (size - N) * MODIFIED_STEP
+    seconds before the corpus was created. """
+    def __init__(self, size=DEFAULT_RECORDS):
+        self.size = size
+        self.created = int(time.time())
+
+    def modified(self, recid):
+        return self.created - (self.size - recid) * MODIFIED_STEP
+
+    def sysno(self, recid):
+        return recid + 1000000
+
+    def record(self, recid):
+        modified = time.strftime('%Y%m%d%H%M%S',
+                                 time.localtime(self.modified(recid)))
+        return RECORD_TEMPLATE % {'recid': recid, 'modified': modified,
+                                  'sysno': self.sysno(recid),
+                                  'volume': 80 + recid % 20}
+
+    def textmarc(self, recid):
+        sysno = '%09d' % recid
+        return ('%s 001__ %d\n%s 035__ $$9SPIRES$$a%d\n'
+                '%s 245__ $$aSynthetic record number %d\n' %
+                (sysno, recid, sysno, self.sysno(recid), sysno, recid))
+
+    def search(self, query, modified_since=None):
+        """ Returns the list of matching recids """
+        recids = None
+        for term in re.split(r'\s+or\s+|\s*\|\s*', query.strip(),
+                             flags=re.IGNORECASE):
+            match = RE_TERM.match(term)
+            if not match:
+                continue
+            field, value = match.group(1).lower(), match.group(2)
+            if recids is None:
+                recids = []
+            if field == '970':
+                value = value.upper().replace('SPIRES-', '')
+                if value.isdigit():
+                    recids.append(int(value) - 1000000)
+            elif value.isdigit():
+                recids.append(int(value))
+        if recids is None:
+            recids = xrange(1, self.size + 1)
+        hits = [recid for recid in recids if 1 <= recid <= self.size]
+        if modified_since is not None:
+            hits = [recid for recid in hits
+                    if self.modified(recid) >= modified_since]
+        return sorted(set(hits))
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer the response so headers and body leave in as few packets as
+    # possible, an unbuffered write per header line stalls on delayed ACKs
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.expovariate(1.0 / server.latency))
+        if server.error_rate and random.random() < server.error_rate:
+            self.reply(503, 'Server busy, try again later\n',
+                       {'Retry-After': '1'})
+            return
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        path = parts.path.rstrip('/').split('/')
+        with server.lock:
+            server.requests += 1
+        if parts.path.rstrip('/') == '/search':
+            self.do_search(params)
+        elif len(path) == 5 and path[1] == 'record' and path[3] == 'export':
+            self.do_record(path[2], path[4])
+        else:
+            self.reply(404, 'Not found\n')
+
+    def do_search(self, params):
+        corpus = self.server.corpus
+        since = None
+        if params.get('d1') and params.get('dt') == 'm':
+            since = time.mktime(time.strptime(params['d1'][:19],
+                                              '%Y-%m-%d %H:%M:%S'))
+        hits = corpus.search(params.get('p', ''), since)
+        out_format = params.get('of', 'hb')
+        if out_format == 'id':
+            self.reply(200, dumps(hits), {'Content-Type': 'application/json'})
+            return
+        rg = min(int(params.get('rg') or DEFAULT_RG), MAX_RG)
+        jrec = max(int(params.get('jrec') or 1), 1)
+        if jrec > len(hits):
+            jrec = max(len(hits) - rg + 1, 1)
+        page = hits[jrec - 1:jrec - 1 + rg]
+        if out_format.startswith('t'):
+            self.reply(200, ''.join(corpus.textmarc(recid) for recid in page))
+        else:
+            body = MARCXML_HEADER + '\n'.join(corpus.record(recid)
+                                              for recid in page)
+            self.reply(200, body + '\n' + MARCXML_FOOTER,
+                       {'Content-Type': 'text/xml'})
+
+    def do_record(self, recid, out_format):
+        corpus = self.server.corpus
+        if not recid.isdigit() or not 1 <= int(recid) <= corpus.size:
+            self.reply(404, 'Record not found\n')
+        elif out_format != 'xm':
+            self.reply(404, 'Only xm is served\n')
+        else:
+            self.reply(200, MARCXML_HEADER + corpus.record(int(recid)) +
+                       '\n' + MARCXML_FOOTER, {'Content-Type': 'text/xml'})
+
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    """ Threaded stand-in server, see the module docstring """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=DEFAULT_PORT, records=DEFAULT_RECORDS,
+                 latency=0.0, error_rate=0.0, verbose=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandinHandler)
+        self.corpus = Corpus(records)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        """ Serves from a background thread, returns the thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    parser = ArgumentParser(description="Serves a synthetic Invenio corpus for harvester tests and benchmarks.")
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('-n', '--records', type=int, default=DEFAULT_RECORDS,
+                        help="Size of the corpus (default %d)" % DEFAULT_RECORDS)
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Mean added latency per request in seconds (exponentially distributed)")
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with 503 and Retry-After: 1")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log every request")
+    arghs = parser.parse_args()
+    server = StandinServer(arghs.port, arghs.records, arghs.latency,
+                           arghs.error_rate, arghs.verbose)
+    sys.stderr.write("Serving %d records on %s\n" % (arghs.records, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Fast streaming MARCXML reader.
+
+Parses records one at a time with lxml's iterparse and throws every element
+away once it has been turned into a record, so memory use does not grow with
+the size of the file. Records come out in the same layout as
+invenio.bibrecord's create_records():
+
+  {tag: [(subfields, ind1, ind2, controlfield_value, global_position)]}
+
+so they can be handed to record_get_field_instances, record_xml_output and
+friends unchanged.
+"""
+
+try:
+    from lxml import etree
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+MARC_NAMESPACE = 'http://www.loc.gov/MARC21/slim'
+RECORD_TAGS = ('{%s}record' % MARC_NAMESPACE, 'record')
+
+
+def _utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _local_name(element):
+    tag = element.tag
+    if not isinstance(tag, basestring):
+        # Comments and processing instructions
+        return None
+    return tag.rsplit('}', 1)[-1]
+
+
+def _indicator(value):
+    value = _utf8(value)
+    if value in ('', '_'):
+        return ' '
+    return value
+
+
+def element_to_record(element, keep_singletons=True):
+    """ Turns a <record> element into a BibRecord structure, numbering the
+    fields the way create_record does (controlfields first) """
+    record = {}
+    datafields = []
+    position = 1
+    for child in element:
+        name = _local_name(child)
+        if name == 'controlfield':
+            value = _utf8(child.text or '')
+            if value or keep_singletons:
+                tag = _utf8(child.get('tag', '!'))
+                record.setdefault(tag, []).append(([], ' ', ' ', value,
+                                                   position))
+                position += 1
+        elif name == 'datafield':
+            datafields.append(child)
+    for child in datafields:
+        subfields = []
+        for subfield in child:
+            if _local_name(subfield) != 'subfield':
+                continue
+            value = _utf8(subfield.text or '')
+            if value or keep_singletons:
+                subfields.append((_utf8(subfield.get('code', '!')), value))
+        if subfields or keep_singletons:
+            tag = _utf8(child.get('tag', '!'))
+            record.setdefault(tag, []).append(
+                (subfields, _indicator(child.get('ind1', '!')),
+                 _indicator(child.get('ind2', '!')), '', position))
+            position += 1
+    return record
+
+
+def iter_create_records(source, keep_singletons=True):
+    """ Generator, yields (record, status, errors) tuples like
+    create_records() does, one record at a time. source is a file name or
+    an open file object (opened in binary mode).
+
+    A document that is not well-formed ends the iteration with a
+    (None, 0, message) tuple, as nothing after the error can be read. """
+    if not HAS_LXML:
+        raise ImportError("iter_create_records needs lxml")
+    context = etree.iterparse(source, events=('end',), tag=RECORD_TAGS,
+                              huge_tree=True)
+    try:
+        for _, element in context:
+            record = element_to_record(element, keep_singletons)
+            # Free the element and the already handled siblings before it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            yield record, 1, ''
+    except etree.XMLSyntaxError as exc:
+        yield None, 0, str(exc)
+    del context
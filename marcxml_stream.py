@@ -0,0 +1,141 @@
+"""
+Helpers for writing MARCXML collections record by record, so harvests never
+have to hold the whole collection in memory.
+"""
+
+import re
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+COLLECTION_OPEN = '<collection xmlns="http://www.loc.gov/MARC21/slim">'
+COLLECTION_CLOSE = '</collection>\n'
+
+REGEX_RECORD = re.compile('<record.*?>.*?</record>', re.DOTALL)
+
+
+class CollectionWriter(object):
+    """ Writes a MARCXML <collection> to an open file handle one record at
+    a time. The opening tag is written on creation (unless header is False,
+    e.g. when appending to a partial collection), the closing tag by
+    close(), which does not close the handle itself. """
+    def __init__(self, handle, declaration=True, header=True):
+        self.handle = handle
+        self.count = 0
+        if header:
+            if declaration:
+                handle.write(XML_DECLARATION)
+            handle.write(COLLECTION_OPEN + '\n')
+
+    def write_record(self, xml):
+        """ Writes a single <record> element """
+        self.handle.write(xml + '\n')
+        self.count += 1
+
+    def write_records_from(self, text):
+        """ Writes every <record> found in text (e.g. a downloaded page),
+        returns how many were written """
+        found = 0
+        for xml in REGEX_RECORD.findall(text):
+            self.write_record(xml)
+            found += 1
+        return found
+
+    def write_raw(self, text):
+        """ Writes text as-is, not counted as a record """
+        self.handle.write(text)
+
+    def close(self):
+        self.handle.write(COLLECTION_CLOSE)
+        self.handle.flush()
+
+
+REGEX_RECID = re.compile(r'<controlfield tag="001">\s*([0-9]+)\s*</controlfield>')
+# Bytes read at a time by iter_records
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_records(handle, chunk_size=CHUNK_SIZE, tag='record'):
+    """ Generator, yields the text of every <record> element in an open
+    MARCXML file while only holding one chunk and one record in memory.
+    tag is the element's name as written, e.g. 'marc:record' for a file
+    using a namespace prefix """
+    close_tag = '</%s>' % (tag,)
+    buf = ''
+    pos = 0
+    while True:
+        start = _find_record_start(buf, pos, tag)
+        if start >= 0:
+            end = buf.find(close_tag, start)
+            if end >= 0:
+                end += len(close_tag)
+                yield buf[start:end]
+                pos = end
+                continue
+            buf = buf[start:]
+        else:
+            # Keep a tail in case '<record' is split across chunks
+            buf = buf[max(pos, len(buf) - len(tag) - 2):]
+        pos = 0
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+
+
+def iter_commented_records(handle, chunk_size=CHUNK_SIZE):
+    """ Generator like iter_records, but yields (comments, xml) tuples where
+    comments is the text from the first comment to the end of the last
+    comment found between the previous record and this one ('' if there
+    are none), e.g. the BibMatch header of the record """
+    buf = ''
+    pos = 0
+    while True:
+        start = _find_record_start(buf, pos)
+        if start >= 0:
+            end = buf.find('</record>', start)
+            if end >= 0:
+                end += len('</record>')
+                yield _comment_block(buf, pos, start), buf[start:end]
+                pos = end
+                continue
+            buf = buf[pos:]
+        elif buf.find('<!--', pos) >= 0:
+            # The comments may belong to a record in the next chunk
+            buf = buf[pos:]
+        else:
+            buf = buf[max(pos, len(buf) - len('<record ')):]
+        pos = 0
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+
+
+def _comment_block(text, start, end):
+    """ The text from the first '<!--' to the last '-->' in text[start:end] """
+    first = text.find('<!--', start, end)
+    if first < 0:
+        return ''
+    last = text.rfind('-->', first, end)
+    if last < 0:
+        return ''
+    return text[first:last + len('-->')]
+
+
+def _find_record_start(text, pos=0, tag='record'):
+    """ Offset of the next '<record>' or '<record ...>' tag, or -1 """
+    opening = '<' + tag
+    size = len(opening)
+    while True:
+        pos = text.find(opening, pos)
+        if pos < 0 or text[pos + size:pos + size + 1] in ('>', ' ', '\t', '\r', '\n'):
+            return pos
+        if pos + size >= len(text):
+            # Can't tell yet, the tag is cut off at the end of text
+            return -1
+        pos += size
+
+
+def get_recid(xml):
+    """ Returns the 001 of a record's text, or None """
+    match = REGEX_RECID.search(xml)
+    return match.group(1) if match else None
@@ -0,0 +1,171 @@
+"""
+Adaptive rate limiting and retry with backoff for the HTTP fetchers.
+
+Every host gets one token bucket shared by all threads talking to it. The
+rate creeps up with each successful request and is halved whenever the
+server answers 429 or 503 (additive increase, multiplicative decrease), so
+a harvest settles at the fastest rate the server tolerates. A Retry-After
+header pauses every thread using that host for as long as asked.
+"""
+
+import time
+import random
+import threading
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlsplit
+
+# Requests per second a new host starts at, and the bounds it moves within
+DEFAULT_RATE = 2.0
+MIN_RATE = 0.05
+MAX_RATE = 50.0
+# Requests that may be sent back to back after an idle period
+DEFAULT_BURST = 4
+# Added to the rate after every successful request
+RATE_INCREASE = 0.1
+# The rate is multiplied by this when the server pushes back
+RATE_DECREASE = 0.5
+# Backoff between retries: random wait up to BASE * 2^attempt, capped
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# Statuses telling us to slow down, and those worth retrying at all
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+class RateLimiter(object):
+    """ Thread-safe token bucket whose rate adapts to server push-back """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Blocks until a request may be sent """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def success(self):
+        """ Call after a request went through, nudges the rate up """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def throttled(self, retry_after=None):
+        """ Call when the server pushed back, halves the rate and pauses
+        everybody for retry_after seconds if given """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self.tokens = 0.0
+            if retry_after:
+                self.paused_until = max(self.paused_until,
+                                        time.time() + retry_after)
+
+
+def get_limiter(url):
+    """ Returns the limiter shared by everything fetching from url's host """
+    host = urlsplit(url).netloc or url
+    with _LIMITERS_LOCK:
+        if host not in _LIMITERS:
+            _LIMITERS[host] = RateLimiter()
+        return _LIMITERS[host]
+
+
+def set_rate(url, rate):
+    """ Caps the requests per second sent to url's host at rate (a
+    politeness budget); the limiter still slows down below it when the
+    server pushes back """
+    limiter = get_limiter(url)
+    with limiter._lock:
+        limiter.max_rate = float(rate)
+        limiter.rate = min(limiter.rate, limiter.max_rate)
+        limiter.min_rate = min(limiter.min_rate, limiter.max_rate)
+    return limiter
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (delay or HTTP date) """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+def error_status(exc):
+    """ Returns (HTTP status, Retry-After seconds) carried by an exception
+    from fetchpool, urllib2 or InvenioConnector, (None, None) otherwise """
+    status = getattr(exc, 'status', None) or getattr(exc, 'code', None)
+    retry_after = getattr(exc, 'retry_after', None)
+    if retry_after is None:
+        headers = getattr(exc, 'headers', None) or getattr(exc, 'hdrs', None)
+        if headers is not None:
+            retry_after = headers.get('retry-after')
+    if not isinstance(status, int):
+        status = None
+    return status, parse_retry_after(retry_after)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """ Exponential backoff with full jitter for the given attempt (0-based) """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call_with_backoff(func, *args, **kwargs):
+    """ Calls func(*args, **kwargs) through a rate limiter, retrying failed
+    calls with jittered exponential backoff.
+
+    Keyword arguments consumed here:
+     * limiter - RateLimiter to go through (default: none)
+     * attempts - calls made before the last exception is re-raised
+     * retry_on - exception classes that trigger a retry (default IOError)
+     * cap - longest wait between two attempts, in seconds
+    Client errors such as 404 are raised straight away. """
+    limiter = kwargs.pop('limiter', None)
+    attempts = kwargs.pop('attempts', 5)
+    retry_on = kwargs.pop('retry_on', (IOError,))
+    cap = kwargs.pop('cap', BACKOFF_CAP)
+    for attempt in xrange(attempts):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            result = func(*args, **kwargs)
+        except retry_on as exc:
+            status, retry_after = error_status(exc)
+            if status in THROTTLE_STATUSES and limiter is not None:
+                limiter.throttled(retry_after)
+            if attempt == attempts - 1:
+                raise
+            if status is not None and status not in RETRY_STATUSES:
+                raise
+            delay = retry_after or backoff_delay(attempt, cap=cap)
+            print "Error (%s), retrying in %.1fs (Attempt %d)" % (
+                exc, delay, attempt + 1)
+            time.sleep(min(delay, cap))
+        else:
+            if limiter is not None:
+                limiter.success()
+            return result
@@ -9,34 +9,137 @@ import sys
 import getopt
 import tempfile
 import time
-from invenio.invenio_connector import InvenioConnector
+from json import load, dump
+from urllib import urlencode
+from urllib2 import URLError
 from invenio.bibrecord import create_records, record_get_field_value, \
                               record_add_field, record_delete_field, \
-                              record_has_field, record_xml_output
+                              record_has_field, record_xml_output, \
+                              record_get_field_values
 from invenio.xmlmarc2textmarc import get_sysno_from_record, create_marc_record, get_sysno_generator
+from ratelimit import call_with_backoff, get_limiter
+from fetchpool import KeepAliveFetcher
+from marcxml_stream import iter_records
+from bibmatch_parser import iter_results
+from record_store import get_store, DEFAULT_PATH as DEFAULT_STORE
 
-re_matched_recid = re.compile("<!-- BibMatch-Matching-Found: http[s:]{1,2}\/\/.+?\/record\/([0-9]*) -->")
 #re_original_recid = re.compile("<controlfield tag=\"001\">([0-9]*)<\/controlfield>")
-re_original_id = re.compile("035__ .*?\$\$9CDS\$\$[az][\s]*([0-9]*).*?|035__ .*?\$\$[az][\s]*([0-9]*)\$\$9CDS.*?")
-re_original_id_spires = re.compile("035__ .*?\$\$9SPIRES\$\$[az][\s]*([0-9]*).*?|035__ .*?\$\$[az][\s]*([0-9]*)\$\$9SPIRES.*?", re.IGNORECASE)
-re_original_id_inspire = re.compile("035__ .*?\$\$9Inspire\$\$[az][\s]*([0-9]*).*?|035__ .*?\$\$[az][\s]*([0-9]*)\$\$9Inspire.*?", re.IGNORECASE)
-re_original_id_cern = re.compile("595__ .*?CDS\-([0-9]*).*?")
 re_matched_mode = re.compile("<!-- BibMatch-Matching-Mode: (.+?) -->")
 re_record = re.compile("([0-9]{3}): (.*)")
 
 IDENTIFIER_MAP = {'inspirebeta.net' : 'Inspire', 'cdsweb.cern.ch' : 'CDS'}
 
-def get_record(server, recid, tries=0):
-    """ Get record by recid from passed Invenio server url """
-    if tries > 5:
+# Identifiers looked up per search request, one less than the records per
+# page (at most 200 in Invenio) so that a full page means there is more
+RESOLVE_BATCH_SIZE = 199
+RESOLVE_PAGE_SIZE = 200
+# Where resolved identifiers are remembered between runs
+DEFAULT_MAP_FILE = os.path.expanduser('~/.recidmap_map.json')
+
+DIGITS = '0123456789'
+WHITESPACE = ' \t\n\r\f\v'
+
+def index_record(record):
+    """
+    Returns the subfield lists of the record's fields with blank indicators,
+    by tag. Built once per record and shared by all identifier patterns.
+    """
+    index = {}
+    for tag, fields in record.iteritems():
+        for subfields, ind1, ind2, _, _ in fields:
+            if ind1 == ' ' and ind2 == ' ':
+                index.setdefault(tag, []).append(subfields)
+    return index
+
+def leading_digits(value):
+    """ The digits at the start of value """
+    end = 0
+    while end < len(value) and value[end] in DIGITS:
+        end += 1
+    return value[:end]
+
+class Identifier035(object):
+    """
+    Finds the number given in 035 $$a (or $$z) next to $$9<identifier>.
+
+    findall(index) returns what the regular expression
+      035__ .*?\$\$9ID\$\$[az][\s]*([0-9]*).*?|035__ .*?\$\$[az][\s]*([0-9]*)\$\$9ID.*?
+    used to find in the TextMARC of the record: a (digits, '') tuple for every
+    035 whose $$9 equals the identifier and is followed by $$a, otherwise a
+    ('', digits) tuple if an $$a made only of digits comes right before a $$9
+    starting with the identifier.
+    """
+    def __init__(self, identifier, ignore_case=False):
+        self.identifier = identifier.lower() if ignore_case else identifier
+        self.ignore_case = ignore_case
+        self.codes = ('a', 'z', 'A', 'Z') if ignore_case else ('a', 'z')
+
+    def _value(self, value):
+        return value.lower() if self.ignore_case else value
+
+    def _find(self, subfields):
+        pairs = zip(subfields, subfields[1:])
+        for (code, value), (next_code, next_value) in pairs:
+            if code == '9' and self._value(value) == self.identifier \
+               and next_code in self.codes:
+                return (leading_digits(next_value.lstrip(WHITESPACE)), '')
+        for (code, value), (next_code, next_value) in pairs:
+            if code in self.codes and next_code == '9' and \
+               self._value(next_value).startswith(self.identifier):
+                number = value.lstrip(WHITESPACE)
+                if leading_digits(number) == number:
+                    return ('', number)
         return None
+
+    def findall(self, index):
+        found = []
+        for subfields in index.get('035', []):
+            match = self._find(subfields)
+            if match is not None:
+                found.append(match)
+        return found
+
+class Prefix595(object):
+    """
+    Finds the number following the first "<prefix>" in the subfields of a
+    595 field, for every 595 holding one; findall(index) returns what
+    595__ .*?CDS\-([0-9]*).*? used to find in the TextMARC of the record.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def findall(self, index):
+        found = []
+        for subfields in index.get('595', []):
+            line = ''.join('$$%s%s' % (code, value) for code, value in subfields)
+            start = line.find(self.prefix)
+            if start >= 0:
+                found.append(leading_digits(line[start + len(self.prefix):]))
+        return found
+
+original_id = Identifier035('CDS')
+original_id_spires = Identifier035('SPIRES', ignore_case=True)
+original_id_inspire = Identifier035('Inspire', ignore_case=True)
+original_id_cern = Prefix595('CDS-')
+
+def get_record(server, recid, store_path=DEFAULT_STORE):
+    """ Get record by recid from passed Invenio server url, reading it from
+    and keeping it in the local record store at store_path (None to always
+    download it) """
+    store = get_store(store_path) if store_path else None
+    if store is not None:
+        xml = store.get(server.server_url, recid)
+        if xml is not None:
+            return create_records(xml)[0][0]
     try:
-        rec = server.get_record(recid)
+        record = call_with_backoff(server.get_record, recid,
+                                   limiter=get_limiter(server.server_url),
+                                   attempts=6, retry_on=(URLError,))
     except URLError:
-        print "Error: Retrying"
-        time.sleep(2.0)
-        return get_record(server, recid, tries + 1)
-    return rec
+        return None
+    if store is not None and record:
+        store.put(server.server_url, recid, record_xml_output(record))
+    return record
 
 def from_bibrec_to_marc(record, sysno="", options={'text-marc':1, 'aleph-marc':0}):
     """ This function will convert a BibRec object into textmarc string """
@@ -46,45 +149,42 @@ def from_bibrec_to_marc(record, sysno="", options={'text-marc':1, 'aleph-marc':0
     return create_marc_record(record, sysno, options)
 
 def inject_recid(data):
-    """ """
+    """ data holds bibmatch_parser.iter_results() tuples """
     updated_records = []
-    for match in data:
-        original_record_bibrec = create_records(match)[0][0]
+    for _, matches, _, _, xml in data:
+        original_record_bibrec = create_records(xml)[0][0]
         if not record_has_field(original_record_bibrec, '001'):
-            rec_id = re_matched_recid.findall(match)[0][1]
+            rec_id = matches[0][1]
             record_add_field(original_record_bibrec, tag='001', controlfield_value=rec_id)
         updated_records.append(original_record_bibrec)
     return updated_records
 
-def parse_resultfile(data, recid_patterns=(re_original_id,), recids=[],
+def parse_resultfile(data, recid_patterns=(original_id,), recids=[],
                      sysno_patterns=None, preserved_tags=[]):
     """
     This function will look for the original recid and any matching recids in a
     BibMatch result file containing references to matching records in comments before
-    every record in MARCXML format.
+    every record in MARCXML format. data holds bibmatch_parser.iter_results() tuples.
 
     Returns a list of BibRec structure with found recids for original and matching records.
     """
     record_pairs = []
-    sysno_gen = get_sysno_generator()
-    options = {'text-marc':1, 'aleph-marc':0}
-    for index, match in enumerate(data):
-        original_record_bibrec = create_records(match)[0][0]
+    for index, (_, matched, _, _, xml) in enumerate(data):
+        original_record_bibrec = create_records(xml)[0][0]
         if record_has_field(original_record_bibrec, '001'):
             rec_id = record_get_field_value(original_record_bibrec, '001')
         else:
-            sysno = sysno_gen.next()
-            original_record_marc = create_marc_record(original_record_bibrec, sysno, options)
+            fields = index_record(original_record_bibrec)
             rec_id = ""
             for pattern in recid_patterns:
-                matches = pattern.findall(original_record_marc)
+                matches = pattern.findall(fields)
                 if len(matches) > 0:
                     rec_id = matches[0]
                     break
         if recids:
             matching_result_recids = [recids[index]]
         else:
-            matching_result_recids = re_matched_recid.findall(match)
+            matching_result_recids = [recid for _, recid in matched]
         matching_result_sysnos = []
         preserved_fields = {}
         print preserved_tags
@@ -97,24 +197,22 @@ def parse_resultfile(data, recid_patterns=(re_original_id,), recids=[],
         record_pairs.append((rec_id, matching_result_recids, matching_result_sysnos, preserved_fields))
     return record_pairs
 
-def parse_noresultfile(data, recid_patterns=(re_original_id,), sysno_patterns=None):
+def parse_noresultfile(data, recid_patterns=(original_id,), sysno_patterns=None):
     """
     This function will look for the original recid in 001 and any matching recids
-    from given regular expression patterns in the textmarc format of given record.
+    from given identifier patterns in the fields of given record.
+    data holds bibmatch_parser.iter_results() tuples.
 
     Returns a list of BibRec structure with found recids for original and matching records.
     """
     record_pairs = []
-    sysno_gen = get_sysno_generator()
-    options = {'text-marc':1, 'aleph-marc':0}
-    for match in data:
-        original_record_bibrec = create_records(match)[0][0]
+    for _, _, _, _, xml in data:
+        original_record_bibrec = create_records(xml)[0][0]
         rec_id = record_get_field_value(original_record_bibrec, '001')
-        sysno = sysno_gen.next()
-        original_record_marc = create_marc_record(original_record_bibrec, sysno, options)
+        fields = index_record(original_record_bibrec)
         matching_result_recids = []
         for pattern in recid_patterns:
-            matches = pattern.findall(original_record_marc)
+            matches = pattern.findall(fields)
             for match in matches:
                 if type(match) is tuple:
                     for res in match:
@@ -128,7 +226,7 @@ def parse_noresultfile(data, recid_patterns=(re_original_id,), sysno_patterns=No
                 break
         matching_result_sysnos = []
         for pattern in sysno_patterns:
-            matches = pattern.findall(original_record_marc)
+            matches = pattern.findall(fields)
             for match in matches:
                 if type(match) is tuple:
                     for res in match:
@@ -144,37 +242,131 @@ def parse_noresultfile(data, recid_patterns=(re_original_id,), sysno_patterns=No
         record_pairs.append((rec_id, matching_result_recids, matching_result_sysnos))
     return record_pairs
 
-def get_sysno_from_recid(server_url, recid):
-    """
-    This function will look for a record with record ID - recid on server - server_url
-    and return the system number - sysno
-    """
-    server = InvenioConnector(server_url)
-    rec = server.search_with_retry(p="001:%s" % (recid,))
-    try:
-        sysno = rec[0][970][0]['a'][0]
-    except (KeyError, IndexError):
-        return None
-
+def normalise_sysno(sysno):
+    """ Strips the SPIRES- prefix or CER suffix off a 970 system number """
     if 'SPIRES' in sysno:
         sysno = sysno.split("-")[1]
     elif 'CER' in sysno:
         sysno = sysno.split("CER")[0]
     return sysno
 
-def get_recid_from_sysno(server_url, sysno):
+class RecidResolver(object):
+    """
+    Maps system numbers (970__a) to record IDs on one server and back.
+
+    Identifiers are looked up RESOLVE_BATCH_SIZE at a time with a single
+    "970:a or 970:b ..." (or "001:...") search over one kept-alive
+    connection, and everything learnt is kept in a JSON map file so later
+    runs only ask for what they have not seen yet.
+    """
+    def __init__(self, server_url, map_file=DEFAULT_MAP_FILE):
+        self.server_url = server_url.rstrip('/')
+        self.map_file = map_file
+        self.fetcher = KeepAliveFetcher()
+        self.requests = 0
+        self.state = {}
+        if map_file and os.path.exists(map_file):
+            with open(map_file) as handle:
+                self.state = load(handle)
+        server = self.state.setdefault(self.server_url, {})
+        self.recid_by_sysno = server.setdefault('recid_by_sysno', {})
+        self.sysnos_by_recid = server.setdefault('sysnos_by_recid', {})
+        # Not found during this run, asked for again next time
+        self.unknown = set()
+
+    def _search(self, terms):
+        """ Returns (recid, 970__a values) of every record matching any of terms """
+        found = []
+        seen = set()
+        jrec = 1
+        while True:
+            url = "%s/search?%s" % (self.server_url, urlencode(
+                {'p': ' or '.join(terms), 'of': 'xm', 'ot': '001,970',
+                 'rg': RESOLVE_PAGE_SIZE, 'jrec': jrec}))
+            xml = call_with_backoff(self.fetcher.get, url, limiter=get_limiter(url),
+                                    attempts=6)
+            self.requests += 1
+            new = 0
+            page = [record for record, code, _ in create_records(xml) if code == 1 and record]
+            for record in page:
+                recid = record_get_field_value(record, '001')
+                if recid in seen:
+                    continue
+                seen.add(recid)
+                new += 1
+                found.append((recid, record_get_field_values(record, '970', code='a')))
+            # Past the last hit Invenio answers with the last page again
+            if len(page) < RESOLVE_PAGE_SIZE or not new:
+                return found
+            jrec += RESOLVE_PAGE_SIZE
+
+    def _learn(self, terms, found, known, key):
+        for recid, sysnos in found:
+            self.sysnos_by_recid[recid] = sysnos
+            for sysno in sysnos:
+                self.recid_by_sysno[sysno.strip().upper()] = recid
+        self.unknown.update(term for term in terms if key(term) not in known)
+        self.save()
+
+    def _resolve(self, wanted, known, key, field):
+        missing = sorted(set(term for term in wanted
+                             if key(term) and key(term) not in known
+                             and key(term) not in self.unknown))
+        for start in xrange(0, len(missing), RESOLVE_BATCH_SIZE):
+            batch = missing[start:start + RESOLVE_BATCH_SIZE]
+            found = self._search(["%s:%s" % (field, term.strip()) for term in batch])
+            self._learn([key(term) for term in batch], found, known, key)
+
+    def recids_for_sysnos(self, sysnos):
+        """ Returns {sysno: recid} for the given 970__a values, "" when not found """
+        key = lambda sysno: sysno.strip().upper()
+        self._resolve(sysnos, self.recid_by_sysno, key, '970')
+        return dict((sysno, self.recid_by_sysno.get(key(sysno), ""))
+                    for sysno in sysnos)
+
+    def sysnos_for_recids(self, recids):
+        """ Returns {recid: system number} for the given record IDs, None when
+        the record has no 970 """
+        key = lambda recid: str(recid).strip()
+        self._resolve(recids, self.sysnos_by_recid, key, '001')
+        result = {}
+        for recid in recids:
+            sysnos = self.sysnos_by_recid.get(key(recid))
+            result[recid] = normalise_sysno(sysnos[0]) if sysnos else None
+        return result
+
+    def save(self):
+        if not self.map_file:
+            return
+        tmp_name = self.map_file + '.tmp'
+        with open(tmp_name, 'w') as handle:
+            dump(self.state, handle)
+        os.rename(tmp_name, self.map_file)
+
+_RESOLVERS = {}
+
+def get_resolver(server_url, map_file=DEFAULT_MAP_FILE):
+    """ Returns the RecidResolver shared by everything resolving on server_url
+    with map_file """
+    key = (server_url.rstrip('/'),
+           os.path.abspath(os.path.expanduser(map_file)) if map_file else None)
+    if key not in _RESOLVERS:
+        _RESOLVERS[key] = RecidResolver(server_url, map_file)
+    return _RESOLVERS[key]
+
+def get_sysno_from_recid(server_url, recid, map_file=DEFAULT_MAP_FILE):
+    """
+    This function will look for a record with record ID - recid on server - server_url
+    and return the system number - sysno
+    """
+    return get_resolver(server_url, map_file).sysnos_for_recids([recid])[recid]
+
+def get_recid_from_sysno(server_url, sysno, map_file=DEFAULT_MAP_FILE):
     """
     This function will look for a record with sysno on server - server_url
     and return the record id
     """
-    server = InvenioConnector(server_url)
-    rec = server.search_with_retry(p="970:%s" % (sysno.strip(),), of='id')
-    print rec
-    try:
-        recid = str(rec[0])
-    except (KeyError, IndexError):
-        return ""
-    return recid
+    return get_resolver(server_url, map_file).recids_for_sysnos([sysno])[sysno]
 
 def load_file(filename):
     "Loads a file's contents into a string"
@@ -183,6 +375,22 @@ def load_file(filename):
     fd.close()
     return res
 
+def check_synced(records, recids):
+    """
+    Passes records through, exits if their number differs from that of the
+    given recids, which are matched to them in order
+    """
+    count = 0
+    for record in records:
+        count += 1
+        if count > len(recids):
+            break
+        yield record
+    sys.stderr.write("Found %d records...\n" % (count,))
+    if count != len(recids):
+        sys.stderr.write("Error parsing data. Records and given Ids is not synced....\n")
+        sys.exit(1)
+
 def get_rec_from_fieldlist(field_list):
     """ """
     rec = {}
@@ -246,6 +454,10 @@ def main():
     --spires
         look for SPIRES specific identifiers
 
+    --map-file
+        where system numbers resolved to record IDs are remembered between runs
+        (default %s)
+
     Examples:
 
     Add Inspire uploaded record IDs to CDS:
@@ -254,9 +466,9 @@ def main():
 
     Add matched record IDs to CDS:
     $ recidmap.py -i Inspire  --inspire bibmatch.matched
-    """
+    """ % (DEFAULT_MAP_FILE,)
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hrni:al:pbc", ["help", "reverse", "nomatch", "ident=", "alter", "recids=", "preserve=", "bare", "cern", "inspire", "spires"])
+        opts, args = getopt.getopt(sys.argv[1:], "hrni:al:pbc", ["help", "reverse", "nomatch", "ident=", "alter", "recids=", "preserve=", "bare", "cern", "inspire", "spires", "map-file="])
     except getopt.GetoptError, e:
         sys.stderr.write("Error:" + str(e) + "\n")
         print usage
@@ -265,9 +477,10 @@ def main():
     nomatch = False
     inject = False
     identifier = None
-    regexps = [re_original_id]
+    regexps = [original_id]
     server_url = "http://inspirebeta.net"
     sysnos = []
+    map_file = DEFAULT_MAP_FILE
     recid_file = ""
     recids = []
     preserved_tags = []
@@ -299,17 +512,18 @@ def main():
             preserved_tags = opt_value.split(',')
 
         if opt in ['-c', '--cern']:
-            regexps.append(re_original_id_cern)
+            regexps.append(original_id_cern)
 
         if opt in ['--inspire']:
-            regexps.append(re_original_id_inspire)
+            regexps.append(original_id_inspire)
 
         if opt in ['--spires']:
-            sysnos.append(re_original_id_spires)
+            sysnos.append(original_id_spires)
+
+        if opt in ['--map-file']:
+            map_file = opt_value
 
     filename = args[0]
-    sys.stderr.write("Reading in %s...\n" % (filename,))
-    data = load_file(filename)
     if '->' in recid_file:
         sys.stderr.write("Reading in record IDs from %s...\n" % (recid_file,))
         start = int(recid_file.split('->')[0].strip())
@@ -327,14 +541,13 @@ def main():
 
     nomatch_records = []
     sys.stderr.write("Parsing data in %s...\n" % (filename,))
+    handle = open(filename)
     if bare:
-        records = [rec + "</record>" for rec in data.split("</record>") if rec != "" and rec != "\n" and rec != "\n</collection>\n"]
+        records = (([], [], None, [], xml) for xml in iter_records(handle))
     else:
-        records = data.split("<!-- BibMatch-Matching-Results: -->\n")[1:]
-    sys.stderr.write("Found %d records...\n" % (len(records),))
-    if recids and len(recids) != len(records):
-        sys.stderr.write("Error parsing data. Records and given Ids is not synced....\n")
-        sys.exit(1)
+        records = iter_results(handle)
+    if recids:
+        records = check_synced(records, recids)
     if inject:
         output_records = inject_recid(records)
     else:
@@ -347,6 +560,15 @@ def main():
 
         sys.stderr.write("Found %d\n" % (len(record_pairs),))
         sys.stderr.write("Preparing data...\n")
+        # Resolve every system number needed below in a few batched searches
+        resolver = get_resolver(server_url, map_file)
+        wanted = ["SPIRES-%s" % (pair[2][0].strip(),) for pair in record_pairs
+                  if pair[1] == [] and pair[2] != []]
+        resolved = {}
+        if wanted:
+            sys.stderr.write("Resolving %d system numbers...\n" % (len(wanted),))
+            resolved = resolver.recids_for_sysnos(wanted)
+            sys.stderr.write("Resolved with %d searches\n" % (resolver.requests,))
         output_records = []
         for recid, match_recids, match_sysno, preserve in record_pairs:
             print identifier, recid, match_recids, match_sysno, preserve
@@ -356,7 +578,7 @@ def main():
                     print "NOMATCH"
                     break
                 else:
-                    match_recid = get_recid_from_sysno(server_url, "SPIRES-%s" % (match_sysno[0].strip(),))
+                    match_recid = resolved["SPIRES-%s" % (match_sysno[0].strip(),)]
                     if match_recid == "":
                         # No recid found
                         nomatch_records.append((recid, match_recid))
@@ -378,6 +600,7 @@ def main():
             output_records.append(rec)
 
 
+    handle.close()
     timestamp = time.strftime("%Y%m%d%H%M%S")
     print output_records
     if len(output_records) > 0:
@@ -2,11 +2,23 @@
 """
 Utility to massage MARCXML records
 
-Add rules for massaging and place the function names in ACTIVE_RULES
+Add rules for massaging and place the function names in ACTIVE_RULES; declare
+the tags a rule reads and writes with @rule so it only runs where it applies
+
+Usage: $ python record_massage.py [-s | -j N] [in.xml] [out.xml]
+
+ -s, --stream   read, massage and write one record at a time, in constant
+                memory
+ -j, --jobs N   parse, massage and output records in N processes, in batches
+                of BATCH_SIZE records; the output keeps the input order
 """
 
 import sys
 import codecs
+import getopt
+from io import BytesIO
+from collections import deque
+from multiprocessing import Pool
 
 from invenio.legacy.bibrecord import (create_records,
                                       record_get_field_instances,
@@ -14,6 +26,15 @@ from invenio.legacy.bibrecord import (create_records,
                                       record_add_field,
                                       record_xml_output)
 
+from marcxml_reader import iter_create_records, HAS_LXML
+from marcxml_stream import iter_records
+
+
+# Read the input with the streaming lxml reader (marcxml_reader) instead of
+# create_records whenever lxml is installed
+FAST_READER = True
+# Records handed to a worker process at a time with --jobs
+BATCH_SIZE = 1000
 
 MARCXML_COLLECTION_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
 <collection xmlns="http://www.loc.gov/MARC21/slim">"""
@@ -22,6 +43,25 @@ MARCXML_COLLECTION_FOOTER = """</collection>"""
 
 # ===================| RULES |========================
 
+def rule(reads=None, writes=()):
+    """Declares the tags a rule reads and writes. The rule is skipped for
+    records holding none of the tags it reads; with reads=None (or no
+    declaration at all) it runs on every record. writes=None declares a rule
+    that may change any tag"""
+    def decorator(func):
+        func.reads = frozenset(reads) if reads is not None else None
+        func.writes = frozenset(writes) if writes is not None else None
+        return func
+    return decorator
+
+
+def is_triggered(rule_func, record):
+    """Whether the rule has anything to work on in record"""
+    reads = getattr(rule_func, 'reads', None)
+    return reads is None or any(tag in record for tag in reads)
+
+
+@rule(reads=['856'], writes=['FFT'])
 def rule_create_fft(record):
     for field in record_get_field_instances(record, '856', ind1='4'):
         url = None
@@ -79,62 +119,116 @@ class MassageTask(object):
 # ==================| CODE |=======================
 
 def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "sj:", ["stream", "jobs="])
+    except getopt.GetoptError as err:
+        _print(TF.RED + "Error: %s" % (err,) + TF.END)
+        sys.exit(1)
+    jobs = 1
+    stream = False
+    for opt, opt_value in opts:
+        if opt in ['-s', '--stream']:
+            stream = True
+        if opt in ['-j', '--jobs']:
+            jobs = int(opt_value)
+    input_file = args[0] if len(args) > 0 else None
+    output_file = args[1] if len(args) > 1 else None
+
+    if jobs > 1:
+        print_active_rules()
+        massage_parallel(input_file, output_file, jobs)
+        return
+    if stream:
+        print_active_rules()
+        massage_stream(input_file, output_file)
+        return
+
     # get records
-    records = get_records()
+    records = get_records(input_file)
     container = MassageTask(records)
 
     # massage with rules
     print_active_rules()
     run_rules(container)
     # output
-    output_records(container)
+    output_records(container, output_file)
 
 
 def _print(msg):
     sys.stderr.write(str(msg) + u'\n')
 
 
-def get_records():
+def get_records(input_file=None):
     """Fetch records either from file or from StdIn"""
-    try:
-        with codecs.open(sys.argv[1], encoding='utf-8', mode='r') as handle:
-            input_xml = handle.read()
-    except Exception:
-        input_xml = sys.stdin.read()
+    if FAST_READER and HAS_LXML:
+        try:
+            handle = open(input_file, 'rb')
+        except Exception:
+            handle = sys.stdin
+        records_in = iter_create_records(handle)
+    else:
+        try:
+            with codecs.open(input_file, encoding='utf-8', mode='r') as handle:
+                input_xml = handle.read()
+        except Exception:
+            input_xml = sys.stdin.read()
+        records_in = create_records(input_xml)
+
+    records_out = list(check_records(records_in))
+    _print(TF.YELLOW + "Processing %d records" % len(records_out) + TF.END)
+    return records_out
 
-    records_out = []
-    for record, code, errors in create_records(input_xml):
+
+def check_records(records_in):
+    """Generator, yields the records from (record, code, errors) tuples,
+    raises ValueError on the first one that could not be parsed"""
+    for record, code, errors in records_in:
         if code != 1:
             msg = "Record Error: %s%s" % (str(record)[:30], str(errors))
             raise ValueError(msg)
-        records_out.append(record)
-    _print(TF.YELLOW + "Processing %d records" % len(records_out) + TF.END)
-    return records_out
+        yield record
 
 
 def print_active_rules():
     """Print active rules to StdErr"""
     _print(TF.BOLD + TF.PURPLE + "Active Rules:" + TF.END * 2)
-    for rule in ACTIVE_RULES:
-        _print(" * %s%s%s" % (TF.GREEN, rule.__name__, TF.END))
+    for rule_func in ACTIVE_RULES:
+        reads = getattr(rule_func, 'reads', None)
+        writes = getattr(rule_func, 'writes', ())
+        _print(" * %s%s%s (reads: %s, writes: %s)" % (
+            TF.GREEN, rule_func.__name__, TF.END,
+            ','.join(sorted(reads)) if reads is not None else 'any',
+            'any' if writes is None else ','.join(sorted(writes)) or 'undeclared'))
 
 
 def run_rules(container):
-    """Specified active rules are ran against records"""
-    for rule in ACTIVE_RULES:
-        for idx, record in enumerate(container):
-            container.records[idx] = rule(record)
+    """Specified active rules are ran against records, all of them on one
+    record before moving to the next"""
+    for idx, record in enumerate(container):
+        container.records[idx] = apply_rules(record)
+
 
+def apply_rules(record):
+    """Runs the active rules that have something to work on in record"""
+    for rule_func in ACTIVE_RULES:
+        if is_triggered(rule_func, record):
+            record = rule_func(record)
+    return record
 
-def output_records(container):
+
+def open_output(output_file=None):
+    """Opens the output file, StdOut if there is none"""
     try:
-        strio = codecs.open(sys.argv[2], mode='w', encoding='utf-8')
-        _print(TF.YELLOW + "Writing to %s" % (sys.argv[2],) + TF.END)
+        strio = codecs.open(output_file, mode='w', encoding='utf-8')
+        _print(TF.YELLOW + "Writing to %s" % (output_file,) + TF.END)
     except Exception:
         strio = sys.stdout
         _print(TF.YELLOW + "Writing to StdOut" + TF.END)
+    return Streamer(strio, '\n')
+
 
-    stream = Streamer(strio, '\n')
+def output_records(container, output_file=None):
+    stream = open_output(output_file)
     stream.write(MARCXML_COLLECTION_HEADER)
     for record in container:
         marcxml = record_xml_output(record)
@@ -142,5 +236,94 @@ def output_records(container):
     stream.write(MARCXML_COLLECTION_FOOTER)
 
 
+# ==================| STREAMING |=======================
+
+def iter_input_records(input_file=None):
+    """Generator, parses the input file (or StdIn) one record at a time"""
+    try:
+        handle = open(input_file, 'rb')
+    except Exception:
+        handle = sys.stdin
+    if FAST_READER and HAS_LXML:
+        records_in = iter_create_records(handle)
+    else:
+        records_in = (create_records(xml)[0] for xml in iter_records(handle))
+    return check_records(records_in)
+
+
+def massage_stream(input_file, output_file):
+    """Massages and writes out every record before reading the next one"""
+    stream = open_output(output_file)
+    stream.write(MARCXML_COLLECTION_HEADER)
+    count = 0
+    for record in iter_input_records(input_file):
+        stream.write(record_xml_output(apply_rules(record)))
+        count += 1
+    stream.write(MARCXML_COLLECTION_FOOTER)
+    _print(TF.YELLOW + "Processed %d records" % (count,) + TF.END)
+
+
+# ==================| PARALLEL |=======================
+
+def read_batches(input_file=None, batch_size=BATCH_SIZE):
+    """Generator, yields lists of up to batch_size record texts read from
+    the input file (or StdIn) without parsing them"""
+    try:
+        handle = open(input_file, 'rb')
+    except Exception:
+        handle = sys.stdin
+    batch = []
+    for xml in iter_records(handle):
+        batch.append(xml)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def massage_batch(batch):
+    """Runs in a worker process: parses a batch of record texts, runs the
+    active rules on them and returns (number of records, their MARCXML)"""
+    text = MARCXML_COLLECTION_HEADER + '\n'.join(batch) + \
+        MARCXML_COLLECTION_FOOTER
+    if FAST_READER and HAS_LXML:
+        records_in = iter_create_records(BytesIO(text))
+    else:
+        records_in = create_records(text)
+    container = MassageTask(list(check_records(records_in)))
+    run_rules(container)
+    return (len(container.records),
+            '\n'.join(record_xml_output(record) for record in container))
+
+
+def massage_parallel(input_file, output_file, jobs):
+    """Massages the input in batches on a pool of jobs processes, writing
+    the batches out in input order. At most 2 * jobs batches are in flight
+    so the input is never held in memory all at once."""
+    stream = open_output(output_file)
+    stream.write(MARCXML_COLLECTION_HEADER)
+    pool = Pool(jobs)
+    pending = deque()
+    count = 0
+    try:
+        for batch in read_batches(input_file):
+            pending.append(pool.apply_async(massage_batch, (batch,)))
+            if len(pending) >= 2 * jobs:
+                done, marcxml = pending.popleft().get()
+                count += done
+                stream.write(marcxml)
+        while pending:
+            done, marcxml = pending.popleft().get()
+            count += done
+            stream.write(marcxml)
+    finally:
+        pool.terminate()
+        pool.join()
+    stream.write(MARCXML_COLLECTION_FOOTER)
+    _print(TF.YELLOW + "Processed %d records with %d jobs" % (count, jobs) +
+           TF.END)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""
+Local store of remote records shared by the tools that download them.
+
+Records are kept zlib compressed in a SQLite database keyed by (host, recid),
+so a record fetched once by any tool is a local lookup for every other tool
+and run until it expires. Entries expire after a TTL and are evicted least
+recently used first once the store grows past its byte budget.
+
+A harvest file can be loaded into the store in bulk:
+
+  $ python record_store.py warm http://inspirehep.net harvest.xml
+"""
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+from urlparse import urlsplit
+from argparse import ArgumentParser
+
+from marcxml_stream import iter_records, get_recid
+
+DEFAULT_PATH = os.path.expanduser('~/.invenio_record_store.sqlite')
+# Seconds before a record is considered stale, 0 never expires
+DEFAULT_TTL = 7 * 24 * 3600
+# Size of the stored records before old ones are evicted
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# Eviction frees space down to this fraction of the budget
+EVICT_TO = 0.9
+# Last access times are only written back when older than this, so that
+# lookups stay reads
+ACCESS_RESOLUTION = 60
+# Records written per transaction when warming from a file
+WARM_BATCH_SIZE = 1000
+# Host variables per SQLite statement stay below the default limit of 999
+SELECT_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    host TEXT NOT NULL,
+    recid TEXT NOT NULL,
+    xml BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    stored REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (host, recid)
+);
+CREATE INDEX IF NOT EXISTS records_accessed ON records (accessed);
+"""
+
+
+def host_key(url):
+    """ Returns the host part of a server URL (or of a bare host name), the
+    way records are keyed in the store """
+    if '://' not in url:
+        url = 'http://' + url
+    return urlsplit(url).netloc.lower()
+
+
+class RecordStore(object):
+    """ Records in MARCXML by (server URL, recid). Safe to share between
+    threads; hit/miss counters are kept for stats(). """
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._size = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get(self, url, recid):
+        """ Returns the MARCXML of record recid from the server at url, or
+        None if it is not stored or has expired """
+        return self.get_many(url, [recid]).get(str(recid))
+
+    def get_many(self, url, recids):
+        """ Returns a dict of recid: MARCXML for the records of recids found
+        in the store """
+        host = host_key(url)
+        recids = [str(recid) for recid in recids]
+        now = time.time()
+        found = {}
+        with self._lock:
+            rows = []
+            for start in xrange(0, len(recids), SELECT_BATCH_SIZE):
+                batch = recids[start:start + SELECT_BATCH_SIZE]
+                rows.extend(self._db.execute(
+                    'SELECT recid, xml, size, stored, accessed FROM records '
+                    'WHERE host = ? AND recid IN (%s)' % (','.join('?' * len(batch)),),
+                    [host] + batch))
+            stale = []
+            touched = []
+            for recid, payload, size, stored, accessed in rows:
+                if self.ttl and now - stored > self.ttl:
+                    stale.append((recid, size))
+                    continue
+                found[recid] = payload
+                if now - accessed > ACCESS_RESOLUTION:
+                    touched.append((now, host, recid))
+            if stale:
+                self._db.executemany('DELETE FROM records WHERE host = ? AND recid = ?',
+                                     [(host, recid) for recid, _ in stale])
+                if self._size is not None:
+                    self._size -= sum(size for _, size in stale)
+                self.expired += len(stale)
+            if touched:
+                self._db.executemany('UPDATE records SET accessed = ? '
+                                     'WHERE host = ? AND recid = ?', touched)
+            if stale or touched:
+                self._db.commit()
+            self.hits += len(found)
+            self.misses += len(set(recids)) - len(found)
+        return dict((recid, zlib.decompress(payload))
+                    for recid, payload in found.iteritems())
+
+    def put(self, url, recid, xml):
+        """ Stores the MARCXML of record recid from the server at url """
+        self.put_many(url, [(recid, xml)])
+
+    def put_many(self, url, records):
+        """ Stores (recid, MARCXML) pairs from the server at url in one
+        transaction, evicting old records if over budget """
+        host = host_key(url)
+        now = time.time()
+        rows = []
+        for recid, xml in records:
+            if isinstance(xml, unicode):
+                xml = xml.encode('utf-8')
+            payload = sqlite3.Binary(zlib.compress(xml))
+            rows.append((host, str(recid), payload, len(payload), now, now))
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO records '
+                                 '(host, recid, xml, size, stored, accessed) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+            if self._size is not None:
+                # Replaced records are counted twice until the next recount
+                self._size += sum(row[3] for row in rows)
+            if self.max_bytes and self._total_size() > self.max_bytes:
+                self._evict()
+
+    def _total_size(self):
+        if self._size is None:
+            self._size = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM records').fetchone()[0]
+        return self._size
+
+    def _evict(self):
+        """ Drops least recently used records until under the budget """
+        self._size = None
+        excess = self._total_size() - self.max_bytes * EVICT_TO
+        doomed = []
+        cursor = self._db.execute('SELECT host, recid, size FROM records '
+                                  'ORDER BY accessed')
+        while excess > 0:
+            rows = cursor.fetchmany(WARM_BATCH_SIZE)
+            if not rows:
+                break
+            for host, recid, size in rows:
+                if excess <= 0:
+                    break
+                doomed.append((host, recid))
+                excess -= size
+        cursor.close()
+        self._db.executemany('DELETE FROM records WHERE host = ? AND recid = ?',
+                             doomed)
+        self._db.commit()
+        self.evicted += len(doomed)
+        self._size = None
+
+    def warm(self, url, handle):
+        """ Stores every record with a 001 in the open MARCXML file handle
+        (e.g. a harvest) as coming from the server at url, returns how many
+        were stored """
+        count = 0
+        batch = []
+        for xml in iter_records(handle):
+            recid = get_recid(xml)
+            if recid is None:
+                continue
+            batch.append((recid, xml))
+            if len(batch) == WARM_BATCH_SIZE:
+                self.put_many(url, batch)
+                count += len(batch)
+                batch = []
+        self.put_many(url, batch)
+        return count + len(batch)
+
+    def purge(self):
+        """ Removes the expired records, returns how many there were """
+        if not self.ttl:
+            return 0
+        with self._lock:
+            removed = self._db.execute('DELETE FROM records WHERE stored < ?',
+                                       (time.time() - self.ttl,)).rowcount
+            self._db.commit()
+            self._size = None
+        return removed
+
+    def clear(self):
+        """ Removes every record """
+        with self._lock:
+            self._db.execute('DELETE FROM records')
+            self._db.commit()
+            self._size = 0
+
+    def count(self):
+        """ Returns the number of stored records """
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def size(self):
+        """ Returns the compressed size of the stored records in bytes """
+        with self._lock:
+            self._size = None
+            return self._total_size()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        return ("Record store %s: %d hits, %d misses (%d expired), %d evicted" %
+                (self.path, self.hits, self.misses, self.expired, self.evicted))
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_store(path=DEFAULT_PATH):
+    """ Returns the RecordStore at path, shared by everything in this
+    process """
+    path = os.path.abspath(os.path.expanduser(path))
+    with _STORES_LOCK:
+        if path not in _STORES:
+            _STORES[path] = RecordStore(path)
+        return _STORES[path]
+
+
+def main():
+    parser = ArgumentParser(description="Manages the local store of remote records.")
+    parser.add_argument('--store', default=DEFAULT_PATH,
+                        help="Record store to use (default %s)" % DEFAULT_PATH)
+    commands = parser.add_subparsers(dest='command')
+    warm = commands.add_parser('warm', help="Load the records of harvest files into the store")
+    warm.add_argument('server', help="Invenio instance the records were harvested from")
+    warm.add_argument('files', nargs='+', help="MARCXML files to load")
+    commands.add_parser('stats', help="Show how many records are stored")
+    commands.add_parser('purge', help="Remove expired records")
+    commands.add_parser('clear', help="Remove every record")
+    arghs = parser.parse_args()
+
+    store = RecordStore(arghs.store)
+    if arghs.command == 'warm':
+        for path in arghs.files:
+            with open(path, 'rb') as handle:
+                print "%s: stored %d records" % (path, store.warm(arghs.server, handle))
+    elif arghs.command == 'purge':
+        print "Removed %d expired records" % (store.purge(),)
+    elif arghs.command == 'clear':
+        store.clear()
+    print "%s: %d records, %.1f MB compressed" % (store.path, store.count(),
+                                                  store.size() / 1048576.0)
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,310 @@
 """
 My program for applying XSLT to XML because BibConvert
 doesn't want to do it!
+
+Usage: $ python xslt_conversion.py [-s] <xsl_file> <xml_file>
+       $ python xslt_conversion.py -b [-j N] [-o dir] <xsl_file> <xml_file>...
+
+ -s, --stream   transform and print one record at a time, in constant memory
+                (the stylesheet must convert every record on its own, as
+                inspire2cds.xsl does)
+ -b, --batch    convert many files (e.g. the shards of a collection) on a pool
+                of processes, each compiling the stylesheet once, in batches
+                of BATCH_SIZE records; writes <name>.converted.xml next to every
+                input file and reports records/sec
+ -j, --jobs N   processes used by --batch (default: one per CPU)
+ -o, --output-dir dir
+                write the --batch outputs to dir instead; inputs of the same
+                name get numbered outputs, <name>-2.converted.xml...
 """
 
+import os
+import re
 import sys
+import time
+import getopt
+from io import BytesIO
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
 from lxml import etree
 
-if len(sys.argv) != 3:
-    print "Usage: $ python %s <xsl_file> <xml_file>" % sys.argv[0]
-    sys.exit(0)
+from marcxml_reader import RECORD_TAGS
+from marcxml_stream import XML_DECLARATION, iter_records
+
+COLLECTION_OPEN = '<collection>\n'
+COLLECTION_CLOSE = '</collection>\n'
+# Records converted by a worker at a time in batch mode
+BATCH_SIZE = 500
+# Records transformed per call of the stylesheet when streaming. Every call
+# loads (and indexes) the knowledge bases the stylesheet reads with
+# document() again, so records are transformed in small groups
+RECORDS_PER_TRANSFORM = 100
+OUTPUT_SUFFIX = '.converted.xml'
+# Bytes at the start of an input file searched for its <collection> tag
+HEAD_SIZE = 64 * 1024
+
+# The opening tag of the collection, with the namespace prefix it uses if any
+RE_COLLECTION_OPEN = re.compile(r'<((?:[\w.-]+:)?)collection(?:\s[^>]*)?>')
+# The first record's tag, e.g. <marc:record>
+RE_RECORD_OPEN = re.compile(r'<((?:[\w.-]+:)?record)[\s>]')
+
+# The stylesheet of a batch worker process, compiled once by init_worker
+_WORKER_XSLT = None
+
+
+def load_stylesheet(xsl_file):
+    """ Parses and compiles the stylesheet in xsl_file. Parsed from its path,
+    files the stylesheet loads with document() (e.g. the knowledge bases of
+    inspire2cds.xsl) are found next to it """
+    return etree.XSLT(etree.parse(xsl_file))
+
+
+def convert_file(xslt, xml_file, handle):
+    """ Transforms the whole of xml_file at once and writes the result to
+    handle """
+    with open(xml_file) as xml_handle:
+        xml = etree.XML(xml_handle.read())
+    translated = xslt(xml)
+    handle.write(etree.tostring(translated, encoding="UTF-8", xml_declaration=True,
+                                pretty_print=True))
+    handle.write('\n')
+
+
+def iter_converted(xslt, source, group_size=RECORDS_PER_TRANSFORM):
+    """ Generator, transforms the records of source (a file name or a file
+    opened in binary mode) group_size at a time and yields the text of each
+    converted record. Only the records being transformed are held in
+    memory """
+    context = etree.iterparse(source, events=('end',), tag=RECORD_TAGS,
+                              huge_tree=True)
+    group = []
+    for _, element in context:
+        # Free the siblings before the element; those still in the group
+        # are kept by it until they have been converted
+        parent = element.getparent()
+        while element.getprevious() is not None:
+            del parent[0]
+        group.append(element)
+        if len(group) == group_size:
+            for text in _convert_group(xslt, group):
+                yield text
+            group = []
+    if group:
+        for text in _convert_group(xslt, group):
+            yield text
+    del context
+
+
+def _convert_group(xslt, records):
+    """ Transforms the record elements in a <collection> of their own, moving
+    them out of the document they were read from, and returns the text of
+    every converted record """
+    collection = etree.Element(records[0].tag[:-len('record')] + 'collection')
+    collection.extend(records)
+    root = xslt(collection).getroot()
+    if root is None:
+        return []
+    return [etree.tostring(record, encoding="UTF-8", pretty_print=True, with_tail=False)
+            for record in root if isinstance(record.tag, basestring)]
+
+
+def convert_stream(xslt, xml_file, handle):
+    """ Transforms xml_file record by record, writing each result to handle
+    as it comes; returns the number of records written """
+    count = 0
+    handle.write(XML_DECLARATION + COLLECTION_OPEN)
+    with open(xml_file, 'rb') as xml_handle:
+        for text in iter_converted(xslt, xml_handle):
+            handle.write(text)
+            count += 1
+    handle.write(COLLECTION_CLOSE)
+    handle.flush()
+    return count
+
+
+# ==================| BATCH |=======================
+
+def init_worker(xsl_file):
+    """ Runs once in every batch worker process: compiles the stylesheet """
+    global _WORKER_XSLT
+    _WORKER_XSLT = load_stylesheet(xsl_file)
+
+
+def convert_batch(task):
+    """ Runs in a batch worker process: converts a batch of record texts,
+    wrapped in the collection tags of the file they came from, and returns
+    (number of records, converted text, seconds taken) """
+    (collection_open, collection_close), batch = task
+    begin = time.time()
+    text = collection_open + '\n'.join(batch) + collection_close
+    converted = list(iter_converted(_WORKER_XSLT, BytesIO(text)))
+    return len(converted), ''.join(converted), time.time() - begin
+
+
+def read_collection_tags(xml_file):
+    """ Returns (opening <collection> tag, closing tag, record tag name) of
+    xml_file. The opening tag holds the namespace declarations the records
+    need, and the names carry the namespace prefix the file uses, e.g.
+    'marc:record'. A bare collection is assumed if there is none """
+    with open(xml_file, 'rb') as handle:
+        head = handle.read(HEAD_SIZE)
+    collection_open, collection_close = '<collection>', '</collection>'
+    match = RE_COLLECTION_OPEN.search(head)
+    if match:
+        collection_open = match.group(0)
+        collection_close = '</%scollection>' % (match.group(1),)
+    match = RE_RECORD_OPEN.search(head, match.end() if match else 0)
+    record_tag = match.group(1) if match else 'record'
+    return collection_open, collection_close, record_tag
+
+
+def iter_batch_tasks(xml_files, batch_size=BATCH_SIZE):
+    """ Generator, yields (file index, task) for batches of up to batch_size
+    record texts of every file in turn, and (file index, None) at the end
+    of each file """
+    for idx, xml_file in enumerate(xml_files):
+        collection_open, collection_close, record_tag = read_collection_tags(xml_file)
+        wrapper = (collection_open, collection_close)
+        batch = []
+        with open(xml_file, 'rb') as handle:
+            for xml in iter_records(handle, tag=record_tag):
+                batch.append(xml)
+                if len(batch) == batch_size:
+                    yield idx, (wrapper, batch)
+                    batch = []
+        if batch:
+            yield idx, (wrapper, batch)
+        yield idx, None
+
+
+def output_path(xml_file, output_dir=None, number=1):
+    """ Where batch mode writes the conversion of xml_file; number tells
+    apart inputs of the same name going to the same output directory """
+    name = os.path.splitext(os.path.basename(xml_file))[0]
+    if number > 1:
+        name += '-%d' % (number,)
+    return os.path.join(output_dir or os.path.dirname(xml_file), name + OUTPUT_SUFFIX)
+
+
+def output_paths(xml_files, output_dir=None):
+    """ Returns the output_path() of every file of xml_files, numbering those
+    that would overwrite the output of an earlier one (e.g. a/part1.xml and
+    b/part1.xml with --output-dir) """
+    paths = []
+    taken = set()
+    for xml_file in xml_files:
+        number = 1
+        path = output_path(xml_file, output_dir)
+        while os.path.abspath(path) in taken:
+            number += 1
+            path = output_path(xml_file, output_dir, number)
+        taken.add(os.path.abspath(path))
+        paths.append(path)
+    return paths
+
+
+def convert_batch_files(xsl_file, xml_files, output_dir=None, jobs=None):
+    """ Converts xml_files on a pool of jobs processes, each compiling the
+    stylesheet once, and writes each result to output_paths(). Batches of
+    the next files are converted while the current one is written, at most
+    2 * jobs batches in flight. Prints records/sec per file (in worker
+    time) and overall (in wall time); returns the number of records """
+    jobs = jobs or cpu_count()
+    pool = Pool(jobs, init_worker, (xsl_file,))
+    pending = deque()
+    outputs = output_paths(xml_files, output_dir)
+    # Per file: [output handle, records, worker seconds]
+    progress = {}
+    total = 0
+    begin = time.time()
+
+    def write(idx, result):
+        if idx not in progress:
+            handle = open(outputs[idx], 'wb')
+            handle.write(XML_DECLARATION + COLLECTION_OPEN)
+            progress[idx] = [handle, 0, 0.0]
+        state = progress[idx]
+        if result is None:
+            state[0].write(COLLECTION_CLOSE)
+            state[0].close()
+            if not state[1] and os.path.getsize(xml_files[idx]):
+                print >> sys.stderr, "Warning: no records found in %s" % (xml_files[idx],)
+            print "%s: %d records, %.2fs, %.1f rec/s -> %s" % (
+                xml_files[idx], state[1], state[2],
+                state[1] / state[2] if state[2] else 0.0, state[0].name)
+            del progress[idx]
+            return 0
+        count, text, elapsed = result.get()
+        state[0].write(text)
+        state[1] += count
+        state[2] += elapsed
+        return count
+
+    try:
+        for idx, task in iter_batch_tasks(xml_files):
+            if task is None:
+                pending.append((idx, None))
+            else:
+                pending.append((idx, pool.apply_async(convert_batch, (task,))))
+            if len(pending) >= 2 * jobs:
+                total += write(*pending.popleft())
+        while pending:
+            total += write(*pending.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+        for handle, _, _ in progress.values():
+            handle.close()
+    elapsed = time.time() - begin
+    print "Converted %d records from %d files in %.2fs with %d jobs, %.1f rec/s" % (
+        total, len(xml_files), elapsed, jobs, total / elapsed if elapsed else 0.0)
+    return total
 
-# Step 1: read data
-xsl_file = sys.argv[1]
-xml_file = sys.argv[2]
 
-with open(xsl_file) as handle:
-    xsl_text = handle.read()
+def main():
+    usage = ("Usage: $ python %s [-s] <xsl_file> <xml_file>\n"
+             "       $ python %s -b [-j N] [-o dir] <xsl_file> <xml_file>..." %
+             (sys.argv[0], sys.argv[0]))
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "sbj:o:",
+                                   ["stream", "batch", "jobs=", "output-dir="])
+    except getopt.GetoptError as err:
+        print "Error: %s" % (err,)
+        print usage
+        sys.exit(1)
+    stream = False
+    batch = False
+    jobs = None
+    output_dir = None
+    for opt, opt_value in opts:
+        if opt in ['-s', '--stream']:
+            stream = True
+        if opt in ['-b', '--batch']:
+            batch = True
+        if opt in ['-j', '--jobs']:
+            jobs = max(1, int(opt_value))
+        if opt in ['-o', '--output-dir']:
+            output_dir = opt_value
 
-with open(xml_file) as handle:
-    xml_text = handle.read()
+    if batch and len(args) >= 2:
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        convert_batch_files(args[0], args[1:], output_dir, jobs)
+        return
+    if len(args) != 2:
+        print usage
+        sys.exit(0)
 
-# Step 2: create XML tree
-xml = etree.XML(xml_text)
+    # Step 1: read and compile the stylesheet
+    xslt = load_stylesheet(args[0])
 
-xsl_xml = etree.XML(xsl_text)
-xslt = etree.XSLT(xsl_xml)
+    # Step 2: convert and output!
+    if stream:
+        convert_stream(xslt, args[1], sys.stdout)
+    else:
+        convert_file(xslt, args[1], sys.stdout)
 
-# Step 3: convert
-translated = xslt(xml)
 
-# Step 4: output!
-print etree.tostring(translated, encoding="UTF-8", xml_declaration=True, pretty_print=True)
+if __name__ == '__main__':
+    main()